@@ -0,0 +1,510 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import asyncio
+import platform
+import tempfile
+import contextlib
+import subprocess
+
+# Offline benchmarks for main.py's hot paths. TelegramClient is swapped for
+# FakeClient (scripted latency, random FloodWait on forwards) before main is
+# imported, so no account, network or session file is needed.
+#
+#   python bench.py                       # everything, JSON on stdout
+#   python bench.py --only dispatch,persistence --out bench_output.txt
+#
+# Persistence is measured for the backend main.py picks (STATE_BACKEND).
+# .gif encodes use the clips in bench_clips/ if present, otherwise short
+# test clips are generated with ffmpeg's lavfi sources.
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+BENCH_CLIPS_DIR = os.path.join(REPO_DIR, "bench_clips")
+BENCHMARKS = ("dispatch", "scheduler", "persistence", "saver", "gif")
+
+for name, value in (("API_ID", "1"), ("API_HASH", "bench"), ("PHONE", "+10000000000"), ("CHANNEL", "-1001")):
+    os.environ.setdefault(name, value)
+
+import telethon
+from telethon import errors, functions, types
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# ================== FAKE TELEGRAM ==================
+class FakeFile:
+    def __init__(self, size):
+        self.size = size
+
+class FakeMedia:
+    def __init__(self, ttl_seconds=None):
+        self.ttl_seconds = ttl_seconds
+        self.document = None
+
+class FakeMessage:
+    def __init__(self, client, id, chat_id, text="", sender_id=None, media=None, size=0, path=None):
+        self.client = client
+        self.id = id
+        self.chat_id = chat_id
+        self.message = text
+        self.sender_id = sender_id
+        self.sender = None
+        self.chat = None
+        self.media = media
+        self.file = FakeFile(size)
+        self.path = path  # local file download_media copies from
+        self.photo = media is not None
+        self.document = None
+        self.video = self.video_note = self.voice = self.audio = self.sticker = None
+
+    async def get_sender(self):
+        await self.client.rpc()
+        return types.User(id=self.sender_id, first_name="Bench", username="bench")
+
+class FakeEvent:
+    def __init__(self, client, text="", chat_id=1, sender_id=None, is_private=False, reply=None, message=None):
+        self.client = client
+        self.message = message or FakeMessage(client, next(client.ids), chat_id, text, sender_id)
+        self.chat_id = chat_id
+        self.sender_id = sender_id
+        self.is_private = is_private
+        self.is_reply = reply is not None
+        self.reply = reply
+        self.edits = []
+
+    async def edit(self, text, **kwargs):
+        self.edits.append(text)
+        return self
+
+    async def delete(self):
+        pass
+
+    async def get_reply_message(self):
+        return self.reply
+
+    async def get_chat(self):
+        return types.User(id=self.chat_id, first_name="Bench")
+
+class FakeClient:
+    # Every RPC sleeps `latency` seconds (+/- `jitter`); forwards raise
+    # FloodWaitError with probability `flood_rate`.
+    latency, jitter, flood_rate, flood_seconds = 0.002, 0.5, 0.0, 1
+    rng = random.Random(0)
+
+    def __init__(self, session=None, api_id=None, api_hash=None, **kwargs):
+        self.ids = iter(range(1, 1 << 62))
+        self.calls = {}
+
+    def on(self, event):
+        return lambda handler: handler
+
+    def add_event_handler(self, handler, event=None):
+        pass
+
+    @property
+    def loop(self):
+        return asyncio.get_running_loop()
+
+    async def rpc(self, name="rpc"):
+        self.calls[name] = self.calls.get(name, 0) + 1
+        await asyncio.sleep(self.latency * (1 + self.jitter * (2 * self.rng.random() - 1)))
+
+    async def __call__(self, request):
+        await self.rpc(type(request).__name__)
+        if isinstance(request, functions.messages.ForwardMessagesRequest) and self.rng.random() < self.flood_rate:
+            raise errors.FloodWaitError(request=request, capture=self.flood_seconds)
+        return None
+
+    async def connect(self):
+        await self.rpc("connect")
+
+    async def start(self, phone=None):
+        return self
+
+    async def disconnect(self):
+        pass
+
+    async def get_me(self):
+        await self.rpc("get_me")
+        return types.User(id=489391295, first_name="Bench", username="bench", is_self=True)
+
+    async def get_input_entity(self, peer):
+        await self.rpc("get_input_entity")
+        return types.InputPeerChannel(channel_id=abs(int(peer)), access_hash=0)
+
+    async def get_entity(self, peer):
+        await self.rpc("get_entity")
+        return types.User(id=abs(int(peer)), first_name="Bench")
+
+    async def get_messages(self, peer, ids=None, **kwargs):
+        await self.rpc("get_messages")
+        return FakeMessage(self, ids, getattr(peer, "channel_id", None))
+
+    async def download_media(self, message, file=None):
+        await self.rpc("download_media")
+        if message.path:
+            shutil.copyfile(message.path, file)
+            return file
+        chunk = b"\0" * (512 * 1024)
+        left = message.file.size
+        while left > 0:
+            file.write(chunk[:left])
+            left -= len(chunk)
+        return file
+
+    async def upload_file(self, file, file_name=None, file_size=None):
+        await self.rpc("upload_file")
+        if isinstance(file, (str, bytes)):
+            return file
+        while file.read(512 * 1024):
+            pass
+        return file_name
+
+    async def send_file(self, entity, file, **kwargs):
+        await self.rpc("send_file")
+        return FakeMessage(self, next(self.ids), entity)
+
+    async def send_message(self, entity, message, **kwargs):
+        await self.rpc("send_message")
+        return FakeMessage(self, next(self.ids), entity, message)
+
+telethon.TelegramClient = FakeClient
+sys.path.insert(0, REPO_DIR)
+import main
+
+# ================== HELPERS ==================
+@contextlib.contextmanager
+def quiet():
+    # main.py prints per banner/save; keep that out of the results.
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+def percentiles(samples):
+    if not samples:
+        return {"p50": None, "p95": None, "p99": None, "max": None}
+    ordered = sorted(samples)
+    pick = lambda q: round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 6)
+    return {"p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99), "max": round(ordered[-1], 6)}
+
+def counter_value(counter, **labels):
+    return counter.values.get(tuple(str(labels[n]) for n in counter.labels), 0)
+
+def reset_state():
+    main.clear_banners()
+    main.aliases.clear()
+    main.dirty_banners.clear()
+    main.dirty_aliases.clear()
+    main.banner_msg_cache.clear()
+    for account in main.accounts.values():
+        account.peer_cache.clear()
+        account.chat_buckets.clear()
+        account.flood_until.clear()
+    main.banner_lag_samples.clear()
+    main.rebuild_dispatch_table()
+
+def process_peak_rss_mb():
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KiB on Linux
+
+def make_banner(chat_id, minutes, next_run):
+    return {
+        "from_chat": chat_id,
+        "msg_id": chat_id % 100000 + 1,
+        "topic_id": None,
+        "minutes": minutes,
+        "next_run": next_run,
+        "chat_title": f"Bench {chat_id}",
+    }
+
+# ================== BENCHMARKS ==================
+async def bench_dispatch(client, args):
+    # Mix of what the outgoing-message handler sees: plain text (fast reject),
+    # unknown commands, built-ins without a delete delay, and aliases with
+    # and without fields.
+    reset_state()
+    main.set_alias("hi", "<b>Hello!</b>")
+    main.set_alias("now", "<b>{date}</b> <i>{tehran_time}</i> by {me}")
+    owner = main.ALLOWED_USERS[0] if main.ALLOWED_USERS else 1
+    texts = ["just chatting", ".unknowncmd", ".card", ".av", ".hi", "ok", ".now", "."]
+    events = [FakeEvent(client, texts[i % len(texts)], sender_id=owner) for i in range(args.messages)]
+
+    latencies = []
+    started = time.perf_counter()
+    for event in events:
+        t = time.perf_counter()
+        await main.commands(event)
+        latencies.append(time.perf_counter() - t)
+    elapsed = time.perf_counter() - started
+    return {
+        "messages": len(events),
+        "seconds": round(elapsed, 6),
+        "messages_per_second": round(len(events) / elapsed, 1),
+        "latency_seconds": percentiles(latencies),
+    }
+
+async def bench_scheduler(client, args):
+    # Every banner is due at once in its own chat. The account-wide token
+    # bucket is lifted so the run measures scheduler and dispatch overhead
+    # rather than the configured send rate.
+    reset_state()
+    for account in main.accounts.values():
+        account.global_bucket = main.TokenBucket(1e9, 1e9)
+    now = main.get_tehran_time()
+    for i in range(args.banners):
+        chat_id = -1000000000000 - i
+        main.schedules[(chat_id, None, 1)] = make_banner(chat_id, 60, now - main.timedelta(seconds=1))
+
+    t = time.perf_counter()
+    main.rebuild_banner_indexes()
+    main.rebuild_schedule_heap()
+    heap_seconds = time.perf_counter() - t
+
+    sent_before = counter_value(main.banner_sends_total, outcome="sent")
+    flood_before = counter_value(main.banner_sends_total, outcome="flood_wait")
+    started = time.perf_counter()
+    scheduler = asyncio.create_task(main.banner_scheduler())
+    deadline = started + args.timeout
+    while counter_value(main.banner_sends_total, outcome="sent") - sent_before < args.banners:
+        if time.perf_counter() > deadline:
+            break
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - started
+    scheduler.cancel()
+    await asyncio.gather(scheduler, *main.banner_tasks, return_exceptions=True)
+
+    sent = counter_value(main.banner_sends_total, outcome="sent") - sent_before
+    lags = [v["stats"]["last_lag"] for v in main.schedules.values() if v.get("stats") and v["stats"]["last_lag"] is not None]
+    return {
+        "banners": args.banners,
+        "sent": sent,
+        "flood_waits": counter_value(main.banner_sends_total, outcome="flood_wait") - flood_before,
+        "timed_out": sent < args.banners,
+        "index_build_seconds": round(heap_seconds, 6),
+        "seconds": round(elapsed, 6),
+        "sends_per_second": round(sent / elapsed, 1),
+        "lag_seconds": percentiles(lags),
+        "rpc_calls": dict(client.calls),
+    }
+
+async def bench_persistence(client, args):
+    reset_state()
+    now = main.get_tehran_time()
+    for i in range(args.banners):
+        chat_id = -1000000000000 - i
+        main.schedules[(chat_id, None, 1)] = make_banner(chat_id, 30 + i % 600, now + main.timedelta(minutes=i % 600))
+    for i in range(args.aliases):
+        main.aliases[f"alias{i}"] = f"<b>Alias {i}</b> " + "x" * 64
+
+    t = time.perf_counter()
+    main.write_state(*main.snapshot_data())
+    save_seconds = time.perf_counter() - t
+    state_files = [main.STATE_DB_FILE, f"{main.STATE_DB_FILE}-wal"] if main.STATE_BACKEND == "sqlite" else [main.SCHEDULES_FILE, main.ALIASES_FILE]
+    snapshot_bytes = sum(os.path.getsize(path) for path in state_files if os.path.exists(path))
+
+    # A flush of 1% of the keys, as persistence_flusher() writes it.
+    for k in list(main.schedules)[:max(1, args.banners // 100)]:
+        main.persist("banner", k)
+    t = time.perf_counter()
+    records = main.collect_journal_records()
+    main.flush_records(records)
+    journal_seconds = time.perf_counter() - t
+
+    reset_state()
+    t = time.perf_counter()
+    main.load()
+    load_seconds = time.perf_counter() - t
+    return {
+        "backend": main.STATE_BACKEND,
+        "banners": args.banners,
+        "aliases": args.aliases,
+        "loaded_banners": len(main.schedules),
+        "loaded_aliases": len(main.aliases),
+        "snapshot_bytes": snapshot_bytes,
+        "save_seconds": round(save_seconds, 6),
+        "journal_records": len(records),
+        "journal_append_seconds": round(journal_seconds, 6),
+        "load_seconds": round(load_seconds, 6),
+    }
+
+async def bench_saver(client, args):
+    sizes = [args.save_size_kb * 1024 * (1 + i % 4) for i in range(args.saves)]
+    workers = [asyncio.create_task(main.saver_worker()) for _ in range(main.SAVER_WORKERS)]
+    stats_before = dict(main.saver_stats)
+
+    started = time.perf_counter()
+    for i, size in enumerate(sizes):
+        while main.saver_queue.full():
+            await asyncio.sleep(0.001)
+        message = FakeMessage(client, next(client.ids), 1000 + i % 50, sender_id=1000 + i % 50, media=FakeMedia(ttl_seconds=10 + i % 30), size=size)
+        await main.auto_self_destruct(FakeEvent(client, message=message))
+    await main.saver_queue.join()
+    elapsed = time.perf_counter() - started
+    for worker in workers:
+        worker.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+
+    delta = {k: main.saver_stats[k] - stats_before[k] for k in ("queued", "saved", "dropped", "failed")}
+    return {
+        "saves": args.saves,
+        **delta,
+        "bytes": sum(sizes),
+        "seconds": round(elapsed, 6),
+        "saves_per_second": round(delta["saved"] / elapsed, 1),
+        "mb_per_second": round(sum(sizes) / 1048576 / elapsed, 1),
+        "peak_buffer_mb": round(main.saver_stats["peak_buffer_bytes"] / 1048576, 2),  # largest single save
+        "process_peak_rss_mb": process_peak_rss_mb(),  # whole bench process, high-water mark
+    }
+
+GIF_VARIANTS = {  # name -> (caption_text, is_wide, raw_speed)
+    "plain": ("", False, 1.0),
+    "text": ("Walt bench", False, 1.0),
+    "wide": ("", True, 1.0),
+    "speed_2x": ("", False, 2.0),
+    "reverse": ("", False, -1.0),
+}
+
+def make_sample_clips(work_dir):
+    # Bundled clips win; otherwise a short video and a still from lavfi.
+    if os.path.isdir(BENCH_CLIPS_DIR):
+        return sorted(os.path.join(BENCH_CLIPS_DIR, f) for f in os.listdir(BENCH_CLIPS_DIR) if not f.startswith("."))
+    clips = []
+    for name, source, extra in (
+        ("video_640x360_5s.mp4", "testsrc=size=640x360:rate=30:duration=5", ["-pix_fmt", "yuv420p"]),
+        ("still_512.png", "testsrc=size=512x512:duration=1", ["-frames:v", "1"]),
+    ):
+        path = os.path.join(work_dir, name)
+        try:
+            subprocess.run([main.FFMPEG_BIN, "-y", "-hide_banner", "-loglevel", "error", "-f", "lavfi", "-i", source, *extra, path],
+                           check=True, timeout=60)
+            clips.append(path)
+        except (OSError, subprocess.SubprocessError) as e:
+            print(f"Could not generate {name}: {e}", file=sys.stderr)
+    return clips
+
+async def offline_font():
+    return main.FONT_FILE if os.path.exists(main.FONT_FILE) else None
+
+async def bench_gif(client, args):
+    main.ensure_fa_font = offline_font  # no font download while benchmarking
+    font = os.path.join(REPO_DIR, main.FONT_FILE)
+    if os.path.exists(font):
+        shutil.copy(font, main.FONT_FILE)
+    await main.probe_gif_toolchain()
+    pipeline = main.gif_toolchain["pipeline"]
+    if not pipeline:
+        return {"skipped": "no ffmpeg or MoviePy pipeline available", "toolchain": main.gif_toolchain}
+
+    clips = make_sample_clips(os.getcwd())
+    runs = []
+    for clip in clips:
+        for variant, (caption_text, is_wide, raw_speed) in GIF_VARIANTS.items():
+            event = FakeEvent(client, ".gif")
+            now = time.monotonic()
+            job = {
+                "event": event,
+                "chat_id": event.chat_id,
+                "reply_message": FakeMessage(client, next(client.ids), event.chat_id, path=clip),
+                "caption_text": caption_text,
+                "is_wide": is_wide,
+                "raw_speed": raw_speed,
+                "speed": abs(raw_speed) or 1.0,
+                "queued_at": now,
+                "started_at": now,
+                "cache_key": f"bench-{next(client.ids)}",
+            }
+            encoded_before = {p: main.gif_encode_seconds.values.get((p,), [0] * (len(main.LATENCY_BUCKETS) + 2))[-2:] for p in ("ffmpeg", "moviepy")}
+            started = time.perf_counter()
+            await main.process_gif(job)
+            elapsed = time.perf_counter() - started
+            encodes = {}
+            for p, (sum_before, count_before) in encoded_before.items():
+                sum_after, count_after = main.gif_encode_seconds.values.get((p,), [0] * (len(main.LATENCY_BUCKETS) + 2))[-2:]
+                if count_after > count_before:
+                    encodes[p] = round(sum_after - sum_before, 6)
+            runs.append({
+                "clip": os.path.basename(clip),
+                "variant": variant,
+                "ok": bool(encodes) and not any("failed" in text for text in event.edits),
+                "encode_seconds": encodes,
+                "job_seconds": round(elapsed, 6),
+            })
+    return {"pipeline": pipeline, "encoder": main.gif_toolchain["encoder"], "clips": len(clips), "runs": runs}
+
+# ================== MAIN ==================
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+async def run(args):
+    client = main.client
+    FakeClient.latency, FakeClient.flood_rate = args.latency, args.flood_rate
+    FakeClient.rng.seed(args.seed)
+    main.me = main.accounts[main.SESSION_NAME].me = await client.get_me()
+
+    results = {}
+    for name in args.only:
+        client.calls.clear()
+        with quiet():
+            try:
+                results[name] = await globals()[f"bench_{name}"](client, args)
+            except Exception as e:
+                results[name] = {"error": f"{type(e).__name__}: {e}"}
+        print(f"• {name} done", file=sys.stderr)
+    return results
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline benchmarks for Walt Self-Bot.")
+    parser.add_argument("--only", default=",".join(BENCHMARKS), help=f"comma-separated subset of: {', '.join(BENCHMARKS)}")
+    parser.add_argument("--latency", type=float, default=FakeClient.latency, help="seconds per fake RPC")
+    parser.add_argument("--flood-rate", type=float, default=0.01, help="probability a forward raises FloodWaitError")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--messages", type=int, default=20000, help="dispatch: outgoing messages")
+    parser.add_argument("--banners", type=int, default=10000, help="scheduler/persistence: schedules")
+    parser.add_argument("--aliases", type=int, default=1000, help="persistence: aliases")
+    parser.add_argument("--saves", type=int, default=200, help="saver: self-destruct messages")
+    parser.add_argument("--save-size-kb", type=int, default=512, help="saver: base media size")
+    parser.add_argument("--timeout", type=float, default=300, help="scheduler: give up after this many seconds")
+    parser.add_argument("--out", help="also write the JSON results to this file")
+    args = parser.parse_args()
+    args.only = [name.strip() for name in args.only.split(",") if name.strip()]
+    unknown = set(args.only) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmark(s): {', '.join(sorted(unknown))}")
+    return args
+
+if __name__ == "__main__":
+    args = parse_args()
+    out_path = os.path.abspath(args.out) if args.out else None
+    work_dir = tempfile.mkdtemp(prefix="walt_bench_")
+    os.chdir(work_dir)  # state files, journal and GIF cache stay out of the repo
+    try:
+        results = asyncio.run(run(args))
+    finally:
+        os.chdir(REPO_DIR)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "config": {k: v for k, v in vars(args).items() if k != "out"},
+        },
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    print(text)
+    if out_path:
+        with open(out_path, "w") as f:
+            f.write(text + "\n")
@@ -1,28 +1,44 @@
+import time
+startup_started = time.perf_counter()
+
 import os
 import io
 import re
+import copy
 import json
-import time
+import heapq
+import shutil
+import pstats
 import signal
-import qrcode
+import string
+import cProfile
+import hashlib
+import sqlite3
 import asyncio
-import requests
+import aiohttp
+from aiohttp import web
+import itertools
 import tempfile
-import jdatetime
-from flask import Flask, jsonify
-from threading import Thread
+import importlib.util
+from threading import Lock
+from collections import OrderedDict, deque
+from html import escape as html_escape
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from zoneinfo import ZoneInfo
 from urllib.parse import urlparse
 from datetime import datetime, timedelta
-from telethon import TelegramClient, events, functions, types
+from telethon import TelegramClient, errors, events, functions, helpers, types, utils
+from telethon.extensions import html as telethon_html
 from telethon.tl.types import DocumentAttributeFilename, DocumentAttributeVideo
 
-try:
-    from moviepy.editor import VideoFileClip, vfx
-except ImportError:
+# qrcode, jdatetime and moviepy are imported on first use (and warmed
+# up in the background after login) so they don't slow down every restart.
+HAS_MOVIEPY = importlib.util.find_spec("moviepy") is not None
+if not HAS_MOVIEPY:
     print("WARNING: MoviePy not installed. GIF fallback will not work. Install with: pip install moviepy")
-    VideoFileClip = None
-    vfx = None
+
+startup_times = {"imports": time.perf_counter() - startup_started}
 
 # ================== SECRETS (.env) ==================
 API_ID = int(os.getenv("API_ID"))
@@ -33,6 +49,61 @@ CHANNEL = int(os.getenv("CHANNEL"))
 ALLOWED_USERS = [489391295]
 MIN_MINUTES = 1
 SESSION_NAME = "walt_self"
+EXTRA_SESSIONS = [name.strip() for name in os.getenv("EXTRA_SESSIONS", "").split(",") if name.strip()]  # more accounts sharing the banner load
+SCHEDULER_HEARTBEAT = 300  # max seconds the scheduler sleeps; keeps /status fresh on idle accounts
+BANNER_MSG_TTL = 6 * 3600  # re-check that a banner's source message still exists this often
+BANNER_CONCURRENCY = 8  # banners forwarded in parallel
+BANNER_CHAT_RATE, BANNER_CHAT_BURST = 1 / 3, 3  # per destination chat: tokens/s, bucket size
+BANNER_GLOBAL_RATE, BANNER_GLOBAL_BURST = 1.0, 5  # whole account
+GIF_WORKERS = int(os.getenv("GIF_WORKERS", 0)) or os.cpu_count() or 1  # concurrent .gif jobs
+GIF_ENCODE_TIMEOUT = 90  # seconds per encode attempt
+GIF_JOB_BUDGET = 240  # seconds for a whole job: download, encode(s), upload
+GIF_FALLBACK_WORKERS = 1  # MoviePy fallback processes
+GIF_CACHE_DIR = "gif_cache"
+FFMPEG_BIN = os.getenv("FFMPEG_BIN", "ffmpeg")
+FONT_FILE = "Vazirmatn-Bold.ttf"
+PROBE_TIMEOUT = 10  # seconds per ffmpeg capability query at startup
+SAVER_SPOOL_BYTES = int(os.getenv("SAVER_SPOOL_BYTES", 8 * 1024 * 1024))  # per-save RAM buffer before spilling to disk
+SAVER_WORKERS = 2  # concurrent self-destruct saves
+QR_CACHE_SIZE = 128  # rendered QR codes (PNG + sent photo) kept in memory
+QR_MAX_BOX_SIZE = 40
+ENTITY_CACHE_TTL = 3600  # seconds a sender/chat name is trusted for saver captions
+SAVER_QUEUE_SIZE = 200  # waiting saves before new ones are dropped
+SAVER_MAX_INFLIGHT_BYTES = 64 * 1024 * 1024  # media bytes being downloaded/uploaded at once
+GIF_CACHE_MAX_BYTES = 200 * 1024 * 1024  # rendered outputs kept on disk
+BANNER_RETRY_BASE = 60  # seconds before retrying a failed banner; doubles per failure, capped at its interval
+BANNER_LAG_WINDOW = 200  # recent send lags kept per banner for percentiles
+BANNER_LAG_GLOBAL_WINDOW = 2000  # recent send lags kept across all banners
+FANOUT_BATCH = 5  # fan-out targets forwarded at once
+FANOUT_STAGGER = 2  # seconds between fan-out batches
+FANOUT_MAX_TARGETS = 100
+PROFILE_DEFAULT_SECONDS, PROFILE_MAX_SECONDS = 30, 300  # .profile window
+PROFILE_TOP = 25  # functions listed per ranking in the .profile report
+
+HTTP_TIMEOUT = 10  # seconds per outbound HTTP attempt
+HTTP_RETRIES = 2  # extra attempts for idempotent requests on timeouts, connection errors, 429 and 5xx
+HTTP_BACKOFF = 0.5  # seconds before the first retry; doubles per attempt
+HTTP_POOL_SIZE, HTTP_PER_HOST = 20, 4  # pooled keep-alive connections: total, per host
+
+# Overridable so the HTTP commands can be pointed at a local stub server.
+TRANSLATE_URL = os.getenv("TRANSLATE_URL", "https://translate.googleapis.com/translate_a/single")
+SHORTENER_URL = os.getenv("SHORTENER_URL", "https://clc.is/api/links")
+FONT_URL = os.getenv("FONT_URL", "https://github.com/rastikerdar/vazirmatn/raw/master/fonts/ttf/Vazirmatn-Bold.ttf")
+
+TRANSLATE_DB_FILE = "translations.db"
+TRANSLATE_MEMORY_SIZE = 512  # translations kept in RAM
+TRANSLATE_DISK_SIZE = 20000  # translations kept on disk
+
+STATE_BACKEND = os.getenv("STATE_BACKEND", "json")  # "json" (snapshots + journal) or "sqlite"
+SCHEDULES_FILE = "banner_schedules.json"
+ALIASES_FILE = "aliases.json"
+JOURNAL_FILE = "walt_state.journal"
+STATE_DB_FILE = "walt_state.db"
+FLUSH_INTERVAL = 2  # seconds to coalesce changes before appending them to the journal
+COMPACT_EVERY = 1000  # journal records before the snapshots are rewritten
+
+WARMUP_IMPORTS = os.getenv("WARMUP_IMPORTS", "1") != "0"  # preload lazy modules after login
+WARMUP_MODULES = ("jdatetime", "qrcode", "moviepy.editor")
 
 CARD_NUMBER = os.getenv("CARD_NUMBER", "مشخص نشده")
 CARD_HOLDER = os.getenv("CARD_HOLDER", "مشخص نشده")
@@ -46,18 +117,39 @@ MESSAGES = {
         "**Banner Activated ✅**\n\n"
         "**💬 • Group:** {chat_title}\n"
         "**🔁 • Interval:** Every {mins}\n"
-        "**🔜 • Next Send:** {next_time}\n\n"
-        "💡 • Stop → use `.stop`"
+        "**🔜 • Next Send:** {next_time}\n"
+        "**🆔 • ID:** `#{banner_id}`\n\n"
+        "💡 • Stop → use `.stop #{banner_id}`"
     ),
     "stop_success": "**Banner Stopped 🚫**\n\n**💬 • Group:** {chat_title}",
+    "stop_success_many": "**{count} Banners Stopped 🚫**\n\n**💬 • Group:** {chat_title}",
     "stop_nothing": "**❌ • No active banner in this group!**",
     "stopall_private": "**🗑 • All banners stopped globally!**\n\n🔢 • Total stopped: **{count}** banner{plural}",
     "stopall_one": "**🚫 • Banner stopped in this group only.**\n\n💡 • Use `.stopall` in Saved Messages to stop everything.",
     "stoppall_nothing": "**❌ • No active banners to stop!**",
+    "fanout_usage": "**💡 • Usage:** Reply with `.fanout 30m @group1 -1001234567890:12 ...`\n(`:topic_id` is optional)",
+    "fanout_too_many": f"**❌ • At most {FANOUT_MAX_TARGETS} target chats!**",
+    "fanout_bad_target": "**❌ • Can't resolve target:** `{target}`",
+    "fanout_success": (
+        "**Fan-out Banner Activated ✅**\n\n"
+        "**🆔 • ID:** `{id}`\n"
+        "**💬 • Targets:** {count} chat{plural}\n"
+        "**🔁 • Interval:** Every {mins}\n"
+        "**🔜 • Next Send:** {next_time}\n\n"
+        "💡 • Stop → use `.fanstop {id}`"
+    ),
+    "fanstop_usage": "**💡 • Usage:** `.fanstop [id]` (see `.list`)",
+    "fanstop_success": "**Fan-out Banner Stopped 🚫**\n\n**🆔 • ID:** `{id}`",
+    "fanstop_nothing": "**❌ • No fan-out banner with ID** `{id}`",
     "list_empty": "**❌ • No active banners right now.**",
     "list_title": "<b>Active Banners List 📃</b>\n\n",
-    "list_item": "<blockquote>🟰 {i}. <b>{title}</b>\n   Interval: Every {mins}\n   Next: {next_run}</blockquote>\n\n",
-    "list_tip": "• Stop one → use <code>.stop</code> in that group\n• Stop all → <code>.stopall</code> in Saved Messages",
+    "list_item": "<blockquote>🟰 {i}. <b>{title}</b>\n   Interval: Every {mins}\n   Next: {next_run}{stats}</blockquote>\n\n",
+    "list_item_stats": "\n   Lag p50/p95/p99: {p50} / {p95} / {p99}\n   Sent: {sent} | Failed: {failed} | Flood waits: {flood_waits}",
+    "list_item_error": "\n   Last error: <code>{error}</code>",
+    "list_item_account": "\n   Account: <code>{account}</code>",
+    "list_item_target": "\n   • {title}: {sent} sent / {failed} failed / {flood_waits} flood waits{error}",
+    "list_global_lag": "<b>Lag (all banners, last {samples} sends):</b> p50 {p50} / p95 {p95} / p99 {p99}\n\n",
+    "list_tip": "• Stop one → use <code>.stop #id</code> in that group\n• Stop all → <code>.stopall</code> in Saved Messages",
     "ping_success": "**• Ping:** `{ping}ms`",
     "ping_error": "**❌ • Ping failed!**",
     "date_tehran": "**🇮🇷 • Tehran:**\n • Time: `{tehran_time}`\n • Date: `{persian_date}`\n\n",
@@ -70,16 +162,20 @@ MESSAGES = {
         "<blockquote>• <code>.card</code> → Show card information.</blockquote>\n"
         "<blockquote>• <code>.ping</code> / <code>.test</code> → Check bot responsiveness.</blockquote>\n"
         "<blockquote>• <code>.date</code> / <code>.time</code> → Show current date & time.</blockquote>\n"
-        "<blockquote>• <code>.set</code> → Set banner & interval.</blockquote>\n"
-        "<blockquote>• <code>.list</code> → List all active banners.</blockquote>\n"
-        "<blockquote>• <code>.stop</code> → Stop banner in current group.</blockquote>\n"
+        "<blockquote>• <code>.set [interval] [topic_id]</code> → Add a banner (several per group are fine).</blockquote>\n"
+        "<blockquote>• <code>.list</code> → List banners in this group (all of them in Saved Messages).</blockquote>\n"
+        "<blockquote>• <code>.stop [#id|topic_id]</code> → Stop banners in current group (or reply to a banner).</blockquote>\n"
         "<blockquote>• <code>.stopall</code> → Stop all banners globally.</blockquote>\n"
-        "<blockquote>• <code>.alias [cmd] [text]</code> → Create a text shortcut.</blockquote>\n"
-        "<blockquote>• <code>.qr [text/url]</code> → Generate a QR code.</blockquote>\n"
+        "<blockquote>• <code>.fanout [interval] [chats]</code> → Send one banner to many chats (<code>@chat</code> or <code>-100id:topic</code>).</blockquote>\n"
+        "<blockquote>• <code>.fanstop [id]</code> → Stop a fan-out banner.</blockquote>\n"
+        "<blockquote>• <code>.alias [cmd] [text]</code> → Create a text shortcut. Fields: <code>{date}</code> <code>{tehran_time}</code> <code>{persian_date}</code> <code>{card}</code> <code>{me}</code>.</blockquote>\n"
+        "<blockquote>• <code>.qr [-s10] [-eL] [text/url]</code> → Generate a QR code. Flags: <code>-s</code> (box size), <code>-e</code> (L/M/Q/H).</blockquote>\n"
         "<blockquote>• <code>.trans [lang]</code> → Translate text (Reply or Inline).</blockquote>\n"
         "<blockquote>• <code>.calc [expression]</code> → Calculate math expression.</blockquote>\n"
         "<blockquote>• <code>.short [url] [slug] [hours]</code> → Shorten a URL.</blockquote>\n"
-        "<blockquote>• <code>.gif [text] [flags]</code> → Create GIF. Flags: <code>-w</code> (wide), <code>-2x</code> (speed).</blockquote>\n",
+        "<blockquote>• <code>.gif [text] [flags]</code> → Create GIF. Flags: <code>-w</code> (wide), <code>-2x</code> (speed).</blockquote>\n"
+        "<blockquote>• <code>.gifcancel</code> → Cancel GIF jobs in this chat.</blockquote>\n"
+        "<blockquote>• <code>.profile [seconds]</code> → Profile the bot and post a report (Saved Messages).</blockquote>\n",
     ),
     "custom_message": "<b>👋 • درود، موجوده عزیز!\n\n✨ • ۱۸ لوکیشن و ۱۰ تانل نیم بها.\n⚡️ • فیلیمو، فیلم نت، نماوا رایگان.\n\n🎁 • تست رایگان: <a href=\"https://t.me/WaltVpnBot?start=fromself\">WaltVpnBot@</a></b>",
     "saver_title": "**Saved Self-Destruct Media ✅**",
@@ -93,11 +189,12 @@ MESSAGES = {
 🇮🇷 • **Iran:** `{persian_date}, {tehran_time}`
 🇬🇧 • **UTC:** `{utc_date}, {utc_time}`
 """.strip(),
-    "alias_usage": "**💡 • Usage:** `.alias [cmd_name] [Your text here]`\nor `.alias del [cmd_name]`",
+    "alias_usage": "**💡 • Usage:** `.alias [cmd_name] [Your text here]`\nor `.alias del [cmd_name]`\nFields: `{date}` `{tehran_time}` `{persian_date}` `{card}` `{me}`",
+    "alias_invalid": "**❌ • Invalid alias template:** `{error}`",
     "alias_success": "**Alias Set ✅**\n\n**• Command:** `{cmd}`\n**• Text:** `{text_preview}`",
     "alias_deleted": "**Alias Deleted 🗑️**\n\n**• Command:** `{cmd}`",
     "alias_not_found": "**❌ • Alias not found:** `{cmd}`",
-    "qr_usage": "**💡 • Usage:** `.qr [Your text or URL here]`",
+    "qr_usage": "**💡 • Usage:** `.qr [-s10] [-eL] [Your text or URL here]`\n-s → box size in px (1-40), -e → error correction (L/M/Q/H)",
     "qr_error": "**❌ • Failed to generate QR code!**",
     "translate_usage": "**💡 • Usage:** `.trans en [Your text here]`\nor Reply to a message.",
     "translate_error": "**❌ • Translation failed! Check your language code and text.**",
@@ -111,9 +208,21 @@ MESSAGES = {
     "gif_usage": "**‼️ • Reply to media!**\nUsage: `.gif [text] [-w] [-2x]`\nExample: `.gif Hello -w -1.5x`",
     "gif_invalid_media": "**❌ • Reply must be to a photo, video, or sticker!**",
     "gif_processing": "**⚙️ • Processing GIF...**\n",
+    "gif_queued": "**⏳ • Queued (#{position})...**\n💡 • Cancel → `.gifcancel`",
+    "gif_cancelled": "**🚫 • GIF job cancelled.**",
+    "gif_cached": "**♻️ • GIF served from cache in** `{elapsed:.3f}s`\n\n",
+    "gif_cancel_done": "**🚫 • Cancelled {count} GIF job(s) in this chat.**",
+    "gif_cancel_nothing": "**❌ • No queued or running GIF jobs in this chat!**",
     "gif_download_failed": "**❌ • Failed to download media!**",
     "gif_conversion_failed": "**❌ • GIF conversion failed!**",
-    "gif_fallback_text": "**⚠️ • FFmpeg failed. Attempting MoviePy fallback (no custom filters)...**\n"
+    "gif_fallback_text": "**⚠️ • FFmpeg failed. Attempting MoviePy fallback (no custom filters)...**\n",
+    "gif_no_drawtext": "**⚠️ • Note: Text skipped, this FFmpeg build has no drawtext filter.**",
+    "gif_unavailable": "**❌ • Neither FFmpeg nor MoviePy is available on this host!**",
+    "profile_usage": f"**💡 • Usage:** `.profile` or `.profile 60` (seconds, max {PROFILE_MAX_SECONDS})",
+    "profile_saved_only": "**❌ • `.profile` works only in Saved Messages!**",
+    "profile_busy": "**❌ • A profile is already running!**",
+    "profile_started": "**🩺 • Profiling for {seconds}s...**",
+    "profile_done": "**🩺 • Profile of the last {seconds}s is ready ✅**"
 }
 
 # ================== GLOBALS ==================
@@ -122,16 +231,71 @@ schedules = {}
 aliases = {}
 stop_event = asyncio.Event()
 
+# Min-heap of (next_run timestamp, seq, schedule key). Entries are never removed
+# in place: stopped or rescheduled banners leave stale entries that the
+# scheduler skips when they reach the top.
+schedule_heap = []
+schedule_seq = itertools.count()
+schedule_changed = asyncio.Event()
+
 last_activity_time = datetime.now() 
 
 signal.signal(signal.SIGINT, lambda s, f: stop_event.set())
 if os.name != "nt":
     signal.signal(signal.SIGTERM, lambda s, f: stop_event.set())
 
-# NEW: Flask app setup
-flask_app = Flask(__name__)
-
 # ================== HELPERS ==================
+class LRUCache:
+    # OrderedDict-backed LRU with an optional per-entry TTL (seconds).
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        item = self.data.get(key)
+        if item is None:
+            return default
+        value, stored_at = item
+        if self.ttl is not None and time.monotonic() - stored_at > self.ttl:
+            del self.data[key]
+            return default
+        self.data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self.data[key] = (value, time.monotonic())
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        item = self.data.pop(key, None)
+        return default if item is None else item[0]
+
+    def clear(self):
+        self.data.clear()
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
 def get_tehran_time():
     global last_activity_time
     last_activity_time = datetime.now()
@@ -145,6 +309,7 @@ def format_interval(minutes: int) -> str:
     return f"{minutes} minute{'s' if minutes != 1 else ''}"
 
 def format_persian_date(dt):
+    import jdatetime
     return jdatetime.datetime.fromgregorian(datetime=dt).strftime("%Y/%m/%d")
 
 def is_url(url):
@@ -154,91 +319,539 @@ def is_url(url):
     except:
         return False
 
-def ensure_fa_font():
-    font_path = "Vazirmatn-Bold.ttf"
+# ================== METRICS ==================
+# Minimal Prometheus text-format metrics, served from /metrics. Everything
+# runs on the event loop, so plain dicts need no locking.
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+BYTES_BUCKETS = tuple(n * 1048576 for n in (0.5, 1, 2, 4, 8, 16, 32, 64))
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name, self.help_text, self.labels = name, help_text, labels
+        self.values = {}
+        METRICS.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[n]) for n in self.labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} counter"
+        for key, value in self.values.items():
+            yield f"{self.name}{format_labels(self.labels, key)} {value}"
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help_text, self.labels, self.buckets = name, help_text, labels, buckets
+        self.values = {}  # label values -> [bucket counts..., sum, count]
+        METRICS.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[n]) for n in self.labels)
+        row = self.values.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                row[i] += 1
+        row[-2] += value
+        row[-1] += 1
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} histogram"
+        for key, row in self.values.items():
+            for bound, count in zip(self.buckets, row):
+                yield f"{self.name}_bucket{format_labels(self.labels + ('le',), key + (str(bound),))} {count}"
+            yield f"{self.name}_bucket{format_labels(self.labels + ('le',), key + ('+Inf',))} {row[-1]}"
+            yield f"{self.name}_sum{format_labels(self.labels, key)} {row[-2]:.6f}"
+            yield f"{self.name}_count{format_labels(self.labels, key)} {row[-1]}"
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    escape = lambda v: v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    pairs = (f'{n}="{escape(v)}"' for n, v in zip(names, values))
+    return "{" + ",".join(pairs) + "}"
+
+METRICS = []
+commands_total = Counter("walt_commands_total", "Commands handled, by outcome.", ("command", "outcome"))
+command_seconds = Histogram("walt_command_seconds", "Command handler latency.", ("command",))
+banner_sends_total = Counter("walt_banner_sends_total", "Banner forward attempts, by outcome.", ("outcome",))
+banner_send_seconds = Histogram("walt_banner_send_seconds", "Banner forward latency.")
+banner_lag_seconds = Histogram("walt_banner_lag_seconds", "Seconds between a banner's scheduled time and its send.")
+saver_jobs_total = Counter("walt_saver_jobs_total", "Self-destruct saves, by outcome.", ("outcome",))
+saver_job_seconds = Histogram("walt_saver_job_seconds", "Self-destruct save latency (download + upload).")
+saver_buffer_bytes = Histogram("walt_saver_buffer_bytes", "Peak bytes a self-destruct save held in RAM.", buckets=BYTES_BUCKETS)
+gif_encodes_total = Counter("walt_gif_encodes_total", "GIF encodes, by pipeline and outcome.", ("pipeline", "outcome"))
+gif_encode_seconds = Histogram("walt_gif_encode_seconds", "GIF encode latency.", ("pipeline",))
+http_requests_total = Counter("walt_http_requests_total", "Outbound HTTP attempts, by host and status.", ("host", "status"))
+http_request_seconds = Histogram("walt_http_request_seconds", "Outbound HTTP attempt latency.", ("host",))
+
+def render_metrics():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    gauges = {
+        "walt_active_banners": len(schedules),
+        "walt_saver_queue_depth": saver_queue.qsize(),
+        "walt_gif_jobs": len(gif_jobs),
+        "walt_seconds_since_activity": round((datetime.now() - last_activity_time).total_seconds(), 3),
+    }
+    for name, value in gauges.items():
+        lines += [f"# TYPE {name} gauge", f"{name} {value}"]
+    return "\n".join(lines) + "\n"
+
+# ================== HTTP ==================
+# One shared aiohttp session (keep-alive pool, per-host limit) for every
+# outbound call, so no command blocks the event loop on network I/O.
+HTTP_IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS", "PUT", "DELETE"})
+http_session = None
+
+def get_http_session():
+    global http_session
+    if http_session is None or http_session.closed:
+        http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=HTTP_POOL_SIZE, limit_per_host=HTTP_PER_HOST, keepalive_timeout=60)
+        )
+    return http_session
+
+async def close_http_session():
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+
+def observe_http(host, status, started):
+    http_requests_total.inc(host=host, status=status)
+    http_request_seconds.observe(time.perf_counter() - started, host=host)
+
+async def http_request(method, url, *, timeout=HTTP_TIMEOUT, retries=None, as_json=True, **kwargs):
+    # Returns (status, body); body is parsed JSON, or raw bytes with as_json=False.
+    # Only idempotent methods are retried by default: a timed-out POST may
+    # still have gone through, and resending it would repeat its effect.
+    if retries is None:
+        retries = HTTP_RETRIES if method.upper() in HTTP_IDEMPOTENT_METHODS else 0
+    host = urlparse(url).hostname
+    for attempt in range(retries + 1):
+        started = time.perf_counter()
+        try:
+            async with get_http_session().request(method, url, timeout=aiohttp.ClientTimeout(total=timeout), **kwargs) as r:
+                if r.status == 429 or r.status >= 500:
+                    raise aiohttp.ClientResponseError(r.request_info, r.history, status=r.status, message=r.reason)
+                body = await r.json(content_type=None) if as_json else await r.read()
+            observe_http(host, r.status, started)
+            return r.status, body
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            observe_http(host, getattr(e, "status", None) or type(e).__name__, started)
+            if attempt == retries:
+                raise
+            await asyncio.sleep(HTTP_BACKOFF * 2 ** attempt)
+
+async def ensure_fa_font():
+    font_path = FONT_FILE
     if not os.path.exists(font_path):
         print("• Downloading Vazirmatn font for GIF overlays...")
         try:
-            url = "https://github.com/rastikerdar/vazirmatn/raw/master/fonts/ttf/Vazirmatn-Bold.ttf"
-            r = requests.get(url, allow_redirects=True)
-            with open(font_path, 'wb') as f:
-                f.write(r.content)
+            status, content = await http_request("GET", FONT_URL, timeout=30, as_json=False)
+            if status != 200:
+                raise RuntimeError(f"HTTP {status}")
+            with open(f"{font_path}.tmp", 'wb') as f:
+                f.write(content)
+            os.replace(f"{font_path}.tmp", font_path)
             print("• Font downloaded successfully.")
         except Exception as e:
             print(f"• Failed to download font: {e}")
             return None
     return font_path
 
+# ================== TRANSLATION CACHE ==================
+# Keyed by (normalized text, target language): an in-memory LRU in front of
+# a size-bounded SQLite table that survives restarts.
+translation_memory = LRUCache(TRANSLATE_MEMORY_SIZE)
+translation_stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+translation_db = None
+translation_db_lock = Lock()
+
+def translation_key(text, lang):
+    return " ".join(text.split()), lang.lower()
+
+def open_translation_db():
+    global translation_db
+    if translation_db is None:
+        translation_db = sqlite3.connect(TRANSLATE_DB_FILE, check_same_thread=False)
+        translation_db.execute(
+            "CREATE TABLE IF NOT EXISTS translations ("
+            "text TEXT NOT NULL, lang TEXT NOT NULL, translated TEXT NOT NULL, used_at REAL NOT NULL, "
+            "PRIMARY KEY (text, lang))"
+        )
+        translation_db.execute("CREATE INDEX IF NOT EXISTS translations_used_at ON translations (used_at)")
+    return translation_db
+
+def translation_db_get(key):
+    with translation_db_lock:
+        db = open_translation_db()
+        row = db.execute("SELECT translated FROM translations WHERE text = ? AND lang = ?", key).fetchone()
+        if row:
+            db.execute("UPDATE translations SET used_at = ? WHERE text = ? AND lang = ?", (time.time(), *key))
+            db.commit()
+        return row[0] if row else None
+
+def translation_db_put(key, translated):
+    with translation_db_lock:
+        db = open_translation_db()
+        db.execute("INSERT OR REPLACE INTO translations VALUES (?, ?, ?, ?)", (*key, translated, time.time()))
+        db.execute(
+            "DELETE FROM translations WHERE rowid IN "
+            "(SELECT rowid FROM translations ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+            (TRANSLATE_DISK_SIZE,)
+        )
+        db.commit()
+
+async def translate(text, lang):
+    key = translation_key(text, lang)
+    cached = translation_memory.get(key)
+    if cached is not None:
+        translation_stats["memory_hits"] += 1
+        return cached
+
+    cached = await asyncio.to_thread(translation_db_get, key)
+    if cached is not None:
+        translation_stats["disk_hits"] += 1
+        translation_memory.set(key, cached)
+        return cached
+
+    translation_stats["misses"] += 1
+    params = {"client": "gtx", "sl": "auto", "tl": lang, "dt": "t", "q": text}
+    status, translation_data = await http_request("GET", TRANSLATE_URL, params=params)
+    if status != 200:
+        raise RuntimeError(f"HTTP {status}")
+
+    translated = translation_data[0][0][0]
+    translation_memory.set(key, translated)
+    await asyncio.to_thread(translation_db_put, key, translated)
+    return translated
+
 # ================== PERSISTENCE ==================
-def load():
-    if os.path.exists("banner_schedules.json"):
+# State lives in two snapshot files plus an append-only journal of per-key
+# changes. Handlers only mark keys dirty; persistence_flusher() coalesces them,
+# appends them to the journal off the event loop and periodically compacts
+# the journal back into the snapshots. With STATE_BACKEND=sqlite the same
+# dirty keys become single-row upserts/deletes in a WAL-mode database instead.
+dirty_banners = set()
+dirty_aliases = set()
+flush_requested = asyncio.Event()
+persist_lock = asyncio.Lock()
+compact_requested = False
+journal_records = 0
+
+def serialize_banner(v):
+    return {
+        "from_chat": v["from_chat"],
+        "msg_id": v["msg_id"],
+        "topic_id": v.get("topic_id"),
+        "minutes": v["minutes"],
+        "next_run": v["next_run"].isoformat(),
+        "chat_title": v["chat_title"],
+        "due_at": v["due_at"].isoformat() if v.get("due_at") else None,
+        "stats": v.get("stats"),
+        "account": v.get("account"),
+        "targets": [
+            {"chat": t["chat"], "topic_id": t.get("topic_id"), "title": t["title"], "stats": t.get("stats")}
+            for t in v["targets"]
+        ] if v.get("targets") is not None else None
+    }
+
+def deserialize_banner(v):
+    return {
+        "from_chat": v["from_chat"],
+        "msg_id": v["msg_id"],
+        "topic_id": v.get("topic_id"),
+        "minutes": v["minutes"],
+        "next_run": datetime.fromisoformat(v["next_run"]).replace(tzinfo=ZoneInfo("Asia/Tehran")),
+        "chat_title": v["chat_title"],
+        "due_at": datetime.fromisoformat(v["due_at"]).replace(tzinfo=ZoneInfo("Asia/Tehran")) if v.get("due_at") else None,
+        "stats": v.get("stats"),
+        "account": v.get("account"),
+        "targets": [dict(t) for t in v["targets"]] if v.get("targets") is not None else None
+    }
+
+def schedule_key(k):
+    # Banners are keyed by (chat id, topic id or None, banner id), stored as
+    # "chat:topic:id" with topic 0 for none; fan-outs by "fanout:<n>". A bare
+    # int is a key from before the index and is re-keyed by rekey_legacy_banners().
+    if k.startswith("fanout:"):
+        return k
+    parts = k.split(":")
+    if len(parts) == 3:
+        chat_id, topic_id, banner_id = map(int, parts)
+        return (chat_id, topic_id or None, banner_id)
+    return int(k)
+
+def schedule_key_str(k):
+    if isinstance(k, tuple):
+        chat_id, topic_id, banner_id = k
+        return f"{chat_id}:{topic_id or 0}:{banner_id}"
+    return str(k)
+
+def persist(kind, key):
+    # Record that schedules[key] / aliases[key] changed (or was removed).
+    (dirty_banners if kind == "banner" else dirty_aliases).add(key)
+    flush_requested.set()
+
+def request_compaction():
+    # For bulk changes (e.g. .stopall) a fresh snapshot is cheaper than a journal entry per key.
+    global compact_requested
+    compact_requested = True
+    flush_requested.set()
+
+def collect_journal_records():
+    records = []
+    for k in dirty_banners:
+        v = schedules.get(k)
+        records.append({"t": "banner", "k": schedule_key_str(k), "v": serialize_banner(v) if v is not None else None})
+    for k in dirty_aliases:
+        records.append({"t": "alias", "k": k, "v": aliases.get(k)})
+    dirty_banners.clear()
+    dirty_aliases.clear()
+    return records
+
+def snapshot_data():
+    dirty_banners.clear()
+    dirty_aliases.clear()
+    return {schedule_key_str(k): serialize_banner(v) for k, v in schedules.items()}, dict(aliases)
+
+def write_atomic(path, data):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def append_journal(records):
+    with open(JOURNAL_FILE, "a") as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+def write_snapshot(banners_data, aliases_data):
+    # Journal records are full values, so replaying them over a newer snapshot
+    # (crash between the two steps below) is harmless.
+    write_atomic(SCHEDULES_FILE, banners_data)
+    write_atomic(ALIASES_FILE, aliases_data)
+    open(JOURNAL_FILE, "w").close()
+
+def snapshot_records(banners_data, aliases_data):
+    return (
+        [{"t": "banner", "k": k, "v": v} for k, v in banners_data.items()] +
+        [{"t": "alias", "k": k, "v": v} for k, v in aliases_data.items()]
+    )
+
+# ---- SQLite backend ----
+state_db = None
+state_db_lock = Lock()
+
+def open_state_db():
+    global state_db
+    if state_db is None:
+        state_db = sqlite3.connect(STATE_DB_FILE, check_same_thread=False)
+        state_db.execute("PRAGMA journal_mode=WAL")
+        state_db.execute("PRAGMA synchronous=NORMAL")  # WAL keeps commits atomic across crashes
+        state_db.execute("CREATE TABLE IF NOT EXISTS banners (key TEXT PRIMARY KEY, next_run REAL NOT NULL, data TEXT NOT NULL)")
+        state_db.execute("CREATE INDEX IF NOT EXISTS banners_next_run ON banners (next_run)")
+        state_db.execute("CREATE TABLE IF NOT EXISTS aliases (name TEXT PRIMARY KEY, text TEXT NOT NULL)")
+        state_db.commit()
+    return state_db
+
+def write_state_db(records, replace=False):
+    # Applies journal-style records in one transaction; replace=True drops
+    # every row first (compaction after bulk changes such as .stopall).
+    with state_db_lock:
+        db = open_state_db()
+        with db:
+            if replace:
+                db.execute("DELETE FROM banners")
+                db.execute("DELETE FROM aliases")
+            for record in records:
+                if record["t"] == "banner" and record["v"] is None:
+                    db.execute("DELETE FROM banners WHERE key = ?", (record["k"],))
+                elif record["t"] == "banner":
+                    db.execute(
+                        "INSERT INTO banners VALUES (?, ?, ?) "
+                        "ON CONFLICT (key) DO UPDATE SET next_run = excluded.next_run, data = excluded.data",
+                        (record["k"], datetime.fromisoformat(record["v"]["next_run"]).timestamp(), json.dumps(record["v"], ensure_ascii=False))
+                    )
+                elif record["v"] is None:
+                    db.execute("DELETE FROM aliases WHERE name = ?", (record["k"],))
+                else:
+                    db.execute("INSERT OR REPLACE INTO aliases VALUES (?, ?)", (record["k"], record["v"]))
+
+def write_state(banners_data, aliases_data):
+    if STATE_BACKEND == "sqlite":
+        write_state_db(snapshot_records(banners_data, aliases_data), replace=True)
+    else:
+        write_snapshot(banners_data, aliases_data)
+
+def flush_records(records):
+    if STATE_BACKEND == "sqlite":
+        write_state_db(records)
+    else:
+        append_journal(records)
+
+def apply_journal_record(record):
+    if record["t"] == "banner":
+        key = schedule_key(record["k"])
+        if record["v"] is None:
+            schedules.pop(key, None)
+        else:
+            schedules[key] = deserialize_banner(record["v"])
+    elif record["t"] == "alias":
+        if record["v"] is None:
+            aliases.pop(record["k"], None)
+        else:
+            aliases[record["k"]] = record["v"]
+
+def load_json_state():
+    global journal_records
+    if os.path.exists(SCHEDULES_FILE):
         try:
-            with open("banner_schedules.json") as f:
+            with open(SCHEDULES_FILE) as f:
                 data = json.load(f)
                 for k, v in data.items():
-                    nr = datetime.fromisoformat(v["next_run"]).replace(tzinfo=ZoneInfo("Asia/Tehran"))
-                    schedules[int(k)] = {
-                        "from_chat": v["from_chat"],
-                        "msg_id": v["msg_id"],
-                        "topic_id": v.get("topic_id"),
-                        "minutes": v["minutes"],
-                        "next_run": nr,
-                        "chat_title": v["chat_title"]
-                    }
-            print(f"Loaded {len(schedules)} banner(s)")
+                    schedules[schedule_key(k)] = deserialize_banner(v)
         except Exception as e:
             print(f"Load error (banners): {e}")
 
-    if os.path.exists("aliases.json"):
+    if os.path.exists(ALIASES_FILE):
         try:
-            with open("aliases.json") as f:
-                global aliases
-                aliases = json.load(f)
-            print(f"Loaded {len(aliases)} alias(es)")
+            with open(ALIASES_FILE) as f:
+                aliases.update(json.load(f))
         except Exception as e:
             print(f"Load error (aliases): {e}")
 
-def save():
-    try:
-        data_to_save = {
-            str(k): {
-                "from_chat": v["from_chat"],
-                "msg_id": v["msg_id"],
-                "topic_id": v.get("topic_id"),
-                "minutes": v["minutes"],
-                "next_run": v["next_run"].isoformat(),
-                "chat_title": v["chat_title"]
-            }
-            for k, v in schedules.items()
-        }
-        with open("banner_schedules.json", "w") as f:
-            json.dump(data_to_save, f, indent=2)
-    except Exception as e:
-        print(f"Save error (banners): {e}")
+    if os.path.exists(JOURNAL_FILE):
+        with open(JOURNAL_FILE) as f:
+            for line in f:
+                try:
+                    apply_journal_record(json.loads(line))
+                    journal_records += 1
+                except Exception as e:
+                    # A torn last line from a crash mid-append; everything before it is intact.
+                    print(f"Load error (journal): {e}")
+
+def load_state_db():
+    with state_db_lock:
+        db = open_state_db()
+        banner_rows = db.execute("SELECT key, data FROM banners ORDER BY next_run").fetchall()
+        alias_rows = db.execute("SELECT name, text FROM aliases").fetchall()
+
+    if not banner_rows and not alias_rows:
+        migrate_json_state()
+        return
+    for key, data in banner_rows:
+        schedules[schedule_key(key)] = deserialize_banner(json.loads(data))
+    aliases.update(alias_rows)
+
+def migrate_json_state():
+    # One-shot: an empty database picks up the JSON snapshots and journal,
+    # which are then renamed to *.migrated so they are not imported again.
+    legacy_files = [path for path in (SCHEDULES_FILE, ALIASES_FILE, JOURNAL_FILE) if os.path.exists(path)]
+    if not legacy_files:
+        return
+    load_json_state()
+    write_state_db(snapshot_records(*snapshot_data()), replace=True)
+    for path in legacy_files:
+        os.replace(path, f"{path}.migrated")
+    print(f"Migrated {len(schedules)} banner(s) and {len(aliases)} alias(es) from JSON to {STATE_DB_FILE}")
 
+def load():
+    if STATE_BACKEND == "sqlite":
+        load_state_db()
+    else:
+        load_json_state()
+
+    rekey_legacy_banners()
+    rebuild_banner_indexes()
+    rebuild_schedule_heap()
+    rebuild_dispatch_table()
+    print(f"Loaded {len(schedules)} banner(s)")
+    print(f"Loaded {len(aliases)} alias(es)")
+
+def save():
+    # Synchronous; used at shutdown once the flusher is idle. SQLite only
+    # needs the pending rows, the JSON backend rewrites the snapshots.
+    global journal_records, compact_requested
     try:
-        with open("aliases.json", "w") as f:
-            json.dump(aliases, f, indent=2)
+        if STATE_BACKEND == "sqlite" and not compact_requested:
+            write_state_db(collect_journal_records())
+        else:
+            write_state(*snapshot_data())
+        journal_records = 0
+        compact_requested = False
     except Exception as e:
-        print(f"Save error (aliases): {e}")
-
-# ================== FLASK ROUTES (NEW) ==================
-@flask_app.route("/status")
-def status_check_json():
+        print(f"Save error: {e}")
+
+async def persistence_flusher():
+    global journal_records, compact_requested
+    while True:
+        await flush_requested.wait()
+        await asyncio.sleep(FLUSH_INTERVAL)
+        flush_requested.clear()
+        async with persist_lock:
+            # The dirty sets are cleared before the write runs; keep a copy so a
+            # failed write can put them back and be retried on the next flush.
+            pending_banners, pending_aliases = set(dirty_banners), set(dirty_aliases)
+            was_compact_requested = compact_requested
+            try:
+                if compact_requested or journal_records >= COMPACT_EVERY:
+                    compact_requested = False
+                    await asyncio.to_thread(write_state, *snapshot_data())
+                    journal_records = 0
+                else:
+                    records = collect_journal_records()
+                    if records:
+                        await asyncio.to_thread(flush_records, records)
+                        if STATE_BACKEND != "sqlite":  # rows are updated in place, nothing to compact
+                            journal_records += len(records)
+            except Exception as e:
+                dirty_banners.update(pending_banners)
+                dirty_aliases.update(pending_aliases)
+                compact_requested = compact_requested or was_compact_requested
+                flush_requested.set()
+                print(f"Save error: {e} (retrying)")
+
+# ================== STATUS SERVER ==================
+# Served by aiohttp on the bot's own event loop, so handlers read the live
+# state directly instead of racing it from another thread.
+async def status_check_json(request):
     now = datetime.now()
     up_time = now - last_activity_time
     
     is_alive = up_time.total_seconds() < 600 
 
-    return jsonify({
+    return web.json_response({
         "status": "UP" if is_alive else "DOWN",
         "last_activity_utc": last_activity_time.isoformat(),
         "bot_uptime_check_seconds": round(up_time.total_seconds(), 2),
-        "active_banners": len(schedules)
+        "active_banners": len(schedules),
+        "state_backend": STATE_BACKEND,
+        "accounts": {
+            name: {"banners": sum(1 for v in schedules.values() if banner_account(v) is account), "flooded_chats": sum(1 for until in account.flood_until.values() if until > time.monotonic())}
+            for name, account in accounts.items()
+        },
+        "translation_cache": {**translation_stats, "memory_entries": len(translation_memory)},
+        "saver": {**saver_stats, "queue_depth": saver_queue.qsize(), "inflight_bytes": saver_inflight_bytes},
+        "startup_seconds": {k: round(v, 3) for k, v in startup_times.items()},
+        "gif_toolchain": gif_toolchain,
+        "banner_lag": {
+            "global": lag_percentiles(banner_lag_samples),
+            "banners": {
+                schedule_key_str(k): {"chat_title": v["chat_title"], **lag_percentiles(v.get("lag_samples")), **(v.get("stats") or {})}
+                for k, v in schedules.items()
+            }
+        }
     })
 
-@flask_app.route("/")
-def status_check_html():
+async def status_check_html(request):
     now = datetime.now()
     up_time = now - last_activity_time
     
@@ -273,668 +886,1767 @@ def status_check_html():
             <p>Last Activity: {last_activity_time.strftime('%Y-%m-%d %H:%M:%S')} UTC</p>
             <p>Uptime Check Since Last Activity: {str(up_time).split('.')[0]}</p>
             <p>Active Banners: {len(schedules)}</p>
-            <p>Using Flask thread to keep an eye on things.</p>
+            <p>GIF Pipeline: {gif_toolchain['pipeline'] or 'unavailable'} (encoder: {gif_toolchain['encoder'] or 'none'}, drawtext: {'yes' if gif_toolchain['drawtext'] else 'no'}, font: {'yes' if gif_toolchain['font'] else 'no'})</p>
+            <p>Saver Queue: {saver_queue.qsize()} waiting, {saver_stats['dropped']} dropped, {saver_stats['failed']} failed</p>
+            <p>Served from the bot's event loop. Metrics at <a href="/metrics">/metrics</a>.</p>
         </div>
     </body>
     </html>
     """
-    return html
+    return web.Response(text=html, content_type="text/html")
 
-# ================== BANNER SCHEDULER ==================
-async def banner_scheduler():
-    while not stop_event.is_set():
-        now = get_tehran_time()
-        for key, info in list(schedules.items()):
-            if info["next_run"] > now:
-                continue
+async def metrics_text(request):
+    return web.Response(text=render_metrics(), content_type="text/plain", headers={"X-Content-Type-Options": "nosniff"})
 
-            try:
-                chat = await client.get_entity(info["from_chat"])
+async def start_status_server():
+    app = web.Application()
+    app.router.add_get("/", status_check_html)
+    app.router.add_get("/status", status_check_json)
+    app.router.add_get("/metrics", metrics_text)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", int(os.getenv("PORT", 8080))).start()
+    return runner
 
-                if info.get("topic_id") is not None:
-                    messages = await client.get_messages(chat, ids=info["msg_id"], reply_to=info["topic_id"])
-                else:
-                    messages = await client.get_messages(chat, ids=info["msg_id"])
-
-                if not messages:
-                    msg = None
-                elif isinstance(messages, list):
-                    msg = messages[0]
-                else:
-                    msg = messages
-
-                if not msg:
-                    print(f"Banner deleted → removing banner: {info['chat_title']}")
-                    del schedules[key]
-                    save()
-                    continue
-
-                topic_id = info.get("topic_id")
-                if topic_id:
-                    await client(functions.messages.ForwardMessagesRequest(
-                        from_peer=info["from_chat"],
-                        id=[msg.id],
-                        to_peer=info["from_chat"],
-                        top_msg_id=topic_id,
-                        random_id=[int.from_bytes(os.urandom(8), 'big', signed=True)]
-                    ))
-                else:
-                    await client.forward_messages(
-                        entity=info["from_chat"],
-                        messages=msg
-                    )
+# ================== BANNER SCHEDULER ==================
+# Resolved InputPeer per chat id, and "source message still exists" flags per
+# banner message, so a steady-state banner fire is a single forward RPC.
+banner_msg_cache = LRUCache(4096, ttl=BANNER_MSG_TTL)
+banner_tasks = set()
+banners_in_flight = set()
+
+class Account:
+    # A logged-in client and its own send limits. The primary account runs
+    # the commands; EXTRA_SESSIONS accounts only forward the banners assigned
+    # to them and save their self-destruct media.
+    def __init__(self, name, client):
+        self.name = name
+        self.client = client
+        self.me = None
+        self.peer_cache = LRUCache(1024)
+        self.slots = asyncio.Semaphore(BANNER_CONCURRENCY)
+        self.global_bucket = TokenBucket(BANNER_GLOBAL_RATE, BANNER_GLOBAL_BURST)
+        self.chat_buckets = {}
+        self.flood_until = {}  # chat id -> time.monotonic() until which FloodWait applies
+
+accounts = {SESSION_NAME: Account(SESSION_NAME, client)}
+
+def banner_account(info):
+    # Banners of an account that is no longer configured fall back to the primary.
+    return accounts.get(info.get("account")) or accounts[SESSION_NAME]
+
+async def assign_banner_account(chat_id):
+    # Channel/supergroup message ids are the same for every member, so any
+    # account in the chat can forward the banner: pick the least loaded one.
+    # Elsewhere message ids are per account and the primary keeps it.
+    if len(accounts) == 1 or not str(chat_id).startswith("-100"):
+        return SESSION_NAME
+    load = {name: 0 for name in accounts}
+    for info in schedules.values():
+        if info.get("account") in load:
+            load[info["account"]] += 1
+    for account in sorted(accounts.values(), key=lambda a: load[a.name]):
+        try:
+            await get_input_peer(account, chat_id)
+            return account.name
+        except Exception:
+            continue  # not a member
+    return SESSION_NAME
+
+async def rebalance_banners():
+    # After startup: banners without a live account get one.
+    for key, info in list(schedules.items()):
+        if info.get("account") not in accounts:
+            info["account"] = await assign_banner_account(info["from_chat"])
+            persist("banner", key)
+
+def rebuild_schedule_heap():
+    schedule_heap[:] = [(v["next_run"].timestamp(), next(schedule_seq), k) for k, v in schedules.items()]
+    heapq.heapify(schedule_heap)
+    schedule_changed.set()
+
+def reschedule(key):
+    # Call after any change to schedules[key] (including removal) so the
+    # scheduler picks up the new deadline without waiting for its timeout.
+    info = schedules.get(key)
+    if info is not None:
+        heapq.heappush(schedule_heap, (info["next_run"].timestamp(), next(schedule_seq), key))
+    if len(schedule_heap) > 2 * len(schedules) + 64:
+        rebuild_schedule_heap()
+    schedule_changed.set()
+
+def banner_msg_key(chat_id, msg_id):
+    # Outside channels/supergroups message ids are unique per account and
+    # MessageDeleted does not say which chat they came from, so key by id alone.
+    return (chat_id if str(chat_id).startswith("-100") else None, msg_id)
+
+# Secondary indexes over schedules, kept in step by add_banner()/drop_banner():
+# regular banners by chat, and every banner (fan-outs too) by source message.
+banners_by_chat = {}  # chat id -> set of keys
+banners_by_source = {}  # banner_msg_key() -> set of keys
+
+def index_banner(key, info):
+    if isinstance(key, tuple):
+        banners_by_chat.setdefault(key[0], set()).add(key)
+    banners_by_source.setdefault(banner_msg_key(info["from_chat"], info["msg_id"]), set()).add(key)
+
+def unindex_banner(key, info):
+    for index, index_key in ((banners_by_chat, key[0] if isinstance(key, tuple) else None),
+                             (banners_by_source, banner_msg_key(info["from_chat"], info["msg_id"]))):
+        keys = index.get(index_key)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del index[index_key]
+
+def rebuild_banner_indexes():
+    banners_by_chat.clear()
+    banners_by_source.clear()
+    for key, info in schedules.items():
+        index_banner(key, info)
+
+def clear_banners():
+    schedules.clear()
+    banners_by_chat.clear()
+    banners_by_source.clear()
+    schedule_heap.clear()
+    schedule_changed.set()
+
+def add_banner(key, info):
+    old = schedules.get(key)
+    if old is not None:
+        unindex_banner(key, old)
+    schedules[key] = info
+    index_banner(key, info)
+    persist("banner", key)
+    reschedule(key)
+
+def drop_banner(key):
+    info = schedules.pop(key)
+    unindex_banner(key, info)
+    persist("banner", key)
+    reschedule(key)
+    return info
+
+def next_banner_id(chat_id):
+    # Unique within the chat, so "#n" in .list/.stop needs no topic.
+    return max((key[2] for key in banners_by_chat.get(chat_id, ())), default=0) + 1
+
+def rekey_legacy_banners():
+    # Old snapshots keyed banners by chat id or bare topic id.
+    legacy = [k for k in schedules if isinstance(k, int)]
+    last_ids = {}
+    for key in schedules:
+        if isinstance(key, tuple):
+            last_ids[key[0]] = max(last_ids.get(key[0], 0), key[2])
+    for k in legacy:
+        info = schedules.pop(k)
+        chat_id = info["from_chat"]
+        last_ids[chat_id] = last_ids.get(chat_id, 0) + 1
+        schedules[(chat_id, info.get("topic_id"), last_ids[chat_id])] = info
+    if legacy:
+        request_compaction()
+
+async def get_input_peer(account, chat_id):
+    peer = account.peer_cache.get(chat_id)
+    if peer is None:
+        peer = await account.client.get_input_entity(chat_id)
+        account.peer_cache.set(chat_id, peer)
+    return peer
+
+async def banner_message_exists(account, peer, info):
+    cache_key = banner_msg_key(info["from_chat"], info["msg_id"])
+    if banner_msg_cache.get(cache_key):
+        return True
+
+    if info.get("topic_id") is not None:
+        messages = await account.client.get_messages(peer, ids=info["msg_id"], reply_to=info["topic_id"])
+    else:
+        messages = await account.client.get_messages(peer, ids=info["msg_id"])
+
+    if isinstance(messages, list):
+        messages = messages[0] if messages else None
+    if not messages:
+        return False
 
-                info["next_run"] = now + timedelta(minutes=info["minutes"])
-                save()
-                print(f"Banner sent → {info['chat_title']} | Next: {info['next_run'].strftime('%H:%M:%S')}")
+    banner_msg_cache.set(cache_key, True)
+    return True
+
+def remove_deleted_banner(key, info):
+    print(f"Banner deleted → removing banner: {info['chat_title']}")
+    banner_msg_cache.pop(banner_msg_key(info["from_chat"], info["msg_id"]))
+    if schedules.get(key) is info:  # not stopped or replaced meanwhile
+        drop_banner(key)
+
+def retry_banner_in(key, info, seconds):
+    # due_at keeps the originally scheduled time so the eventual send's lag
+    # includes every retry.
+    if not info.get("due_at"):
+        info["due_at"] = info["next_run"]
+    info["next_run"] = get_tehran_time() + timedelta(seconds=seconds)
+    persist("banner", key)
+
+# Delivery stats: counters live in the banner record (and so survive
+# restarts); lag samples for the percentiles are kept in memory only.
+banner_lag_samples = deque(maxlen=BANNER_LAG_GLOBAL_WINDOW)
+
+def banner_stats(info):
+    stats = info.get("stats")
+    if stats is None:
+        stats = info["stats"] = {"sent": 0, "failed": 0, "flood_waits": 0, "last_lag": None, "last_rpc": None, "last_sent": None, "last_error": None}
+    return stats
+
+def record_banner_send(info, lag, rpc):
+    stats = banner_stats(info)
+    stats["sent"] += 1
+    stats["last_lag"] = round(lag, 3)
+    stats["last_rpc"] = round(rpc, 3)
+    stats["last_sent"] = get_tehran_time().isoformat()
+    stats["last_error"] = None
+    if "lag_samples" not in info:
+        info["lag_samples"] = deque(maxlen=BANNER_LAG_WINDOW)
+    info["lag_samples"].append(lag)
+    banner_lag_samples.append(lag)
+    banner_lag_seconds.observe(lag)
+
+def record_banner_failure(info, reason, flood=False):
+    stats = banner_stats(info)
+    stats["flood_waits" if flood else "failed"] += 1
+    stats["last_error"] = reason[:200]
+
+def lag_percentiles(samples):
+    if not samples:
+        return {"p50": None, "p95": None, "p99": None, "samples": 0}
+    ordered = sorted(samples)
+    pick = lambda q: round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 3)
+    return {"p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99), "samples": len(ordered)}
+
+def format_lag(seconds):
+    return "—" if seconds is None else f"{seconds:.1f}s"
+
+async def fire_banner(account, key, info):
+    chat_id = info["from_chat"]
+    scheduled = info.get("due_at") or info["next_run"]
+    flood_left = account.flood_until.get(chat_id, 0) - time.monotonic()
+    if flood_left > 0:
+        retry_banner_in(key, info, flood_left)
+        reschedule(key)
+        return
 
-            except Exception as e:
-                print(f"Banner failed: {e}")
-                info["next_run"] = now + timedelta(minutes=info["minutes"])
-                save()
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        peer = await get_input_peer(account, chat_id)
 
-        await asyncio.sleep(15)
+        if not await banner_message_exists(account, peer, info):
+            outcome = "source_deleted"
+            remove_deleted_banner(key, info)
+            return
 
-# ================== COMMAND HANDLER ==================
-@client.on(events.NewMessage(outgoing=True))
-async def commands(event):
-    text = (event.message.message or "").strip().lower()
-    raw_text = event.message.message.strip()
-    me = await client.get_me()
-    if ALLOWED_USERS and event.sender_id not in ALLOWED_USERS:
-        return
+        rpc_started = time.perf_counter()
+        try:
+            await account.client(functions.messages.ForwardMessagesRequest(
+                from_peer=peer,
+                id=[info["msg_id"]],
+                to_peer=peer,
+                top_msg_id=info.get("topic_id") or None,
+                random_id=[int.from_bytes(os.urandom(8), 'big', signed=True)]
+            ))
+        except (errors.MessageIdInvalidError, errors.MessageIdsEmptyError):
+            # The cached existence flag was stale: the source is gone.
+            outcome = "source_deleted"
+            remove_deleted_banner(key, info)
+            return
 
-    current_chat_id = event.chat_id
-    get_tehran_time()
+        outcome = "sent"
+        rpc = time.perf_counter() - rpc_started
+        now = get_tehran_time()
+        record_banner_send(info, (now - scheduled).total_seconds(), rpc)
+        info.pop("failures", None)
+        info["due_at"] = None
+        info["next_run"] = now + timedelta(minutes=info["minutes"])
+        persist("banner", key)
+        print(f"Banner sent → {info['chat_title']} | Next: {info['next_run'].strftime('%H:%M:%S')}")
+
+    except errors.FloodWaitError as e:
+        # Back off this chat only and retry when the server allows it.
+        outcome = "flood_wait"
+        print(f"Banner flood wait ({e.seconds}s): {info['chat_title']}")
+        record_banner_failure(info, f"FloodWait {e.seconds}s", flood=True)
+        account.flood_until[chat_id] = time.monotonic() + e.seconds
+        retry_banner_in(key, info, e.seconds + 1)
 
-    command_parts = raw_text.split(maxsplit=1)
-    if command_parts and command_parts[0].startswith('.'):
-        alias_cmd = command_parts[0][1:]
-        if alias_cmd in aliases:
-            await event.edit(aliases[alias_cmd], parse_mode='html')
+    except Exception as e:
+        print(f"Banner failed: {e}")
+        record_banner_failure(info, f"{type(e).__name__}: {e}")
+        account.peer_cache.pop(chat_id)
+        info["failures"] = info.get("failures", 0) + 1
+        retry_banner_in(key, info, min(info["minutes"] * 60, BANNER_RETRY_BASE * 2 ** (info["failures"] - 1)))
+
+    finally:
+        banner_sends_total.inc(outcome=outcome)
+        banner_send_seconds.observe(time.perf_counter() - started)
+
+    if schedules.get(key) is info:
+        reschedule(key)
+
+# Fan-out banners forward one source message to many target chats. The source
+# is resolved and checked once per round; targets are sent FANOUT_BATCH at a
+# time, FANOUT_STAGGER seconds apart, each with its own stats.
+async def forward_to_target(account, source_peer, info, target, scheduled):
+    chat_id = target["chat"]
+    if account.flood_until.get(chat_id, 0) > time.monotonic():
+        record_banner_failure(target, "FloodWait (skipped this round)", flood=True)
+        return "flood_wait"
+
+    if chat_id not in account.chat_buckets:
+        account.chat_buckets[chat_id] = TokenBucket(BANNER_CHAT_RATE, BANNER_CHAT_BURST)
+    await account.chat_buckets[chat_id].acquire()
+    await account.global_bucket.acquire()
+
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        peer = await get_input_peer(account, chat_id)
+        await account.client(functions.messages.ForwardMessagesRequest(
+            from_peer=source_peer,
+            id=[info["msg_id"]],
+            to_peer=peer,
+            top_msg_id=target.get("topic_id") or None,
+            random_id=[int.from_bytes(os.urandom(8), 'big', signed=True)]
+        ))
+        outcome = "sent"
+        record_banner_send(target, (get_tehran_time() - scheduled).total_seconds(), time.perf_counter() - started)
+    except (errors.MessageIdInvalidError, errors.MessageIdsEmptyError):
+        outcome = "source_deleted"
+    except errors.FloodWaitError as e:
+        outcome = "flood_wait"
+        record_banner_failure(target, f"FloodWait {e.seconds}s", flood=True)
+        account.flood_until[chat_id] = time.monotonic() + e.seconds
+    except Exception as e:
+        record_banner_failure(target, f"{type(e).__name__}: {e}")
+        account.peer_cache.pop(chat_id)
+    finally:
+        banner_sends_total.inc(outcome=outcome)
+        banner_send_seconds.observe(time.perf_counter() - started)
+    return outcome
+
+async def fire_fanout(account, key, info):
+    scheduled = info.get("due_at") or info["next_run"]
+    targets = info["targets"]
+    outcomes = []
+    try:
+        source_peer = await get_input_peer(account, info["from_chat"])
+        if not await banner_message_exists(account, source_peer, info):
+            remove_deleted_banner(key, info)
+            return
+        for i in range(0, len(targets), FANOUT_BATCH):
+            if i:
+                await asyncio.sleep(FANOUT_STAGGER)
+            batch = targets[i:i + FANOUT_BATCH]
+            outcomes += await asyncio.gather(*(forward_to_target(account, source_peer, info, t, scheduled) for t in batch))
+            if "source_deleted" in outcomes:
+                remove_deleted_banner(key, info)
+                return
+    except Exception as e:
+        print(f"Fan-out banner failed: {e}")
+        record_banner_failure(info, f"{type(e).__name__}: {e}")
+        account.peer_cache.pop(info["from_chat"])
+
+    lags = [t["stats"]["last_lag"] for t, outcome in zip(targets, outcomes) if outcome == "sent"]
+    sent = len(lags)
+    if sent:
+        if "lag_samples" not in info:
+            info["lag_samples"] = deque(maxlen=BANNER_LAG_WINDOW)
+        info["lag_samples"].extend(lags)
+        stats = banner_stats(info)
+        stats["sent"] += 1
+        stats["last_lag"] = max(lags)
+        stats["last_sent"] = get_tehran_time().isoformat()
+        stats["last_error"] = None
+        info.pop("failures", None)
+        info["due_at"] = None
+        info["next_run"] = get_tehran_time() + timedelta(minutes=info["minutes"])
+        persist("banner", key)
+        print(f"Fan-out banner sent → {sent}/{len(targets)} chats | Next: {info['next_run'].strftime('%H:%M:%S')}")
+    else:
+        if outcomes:
+            record_banner_failure(info, f"0/{len(targets)} targets delivered")
+        info["failures"] = info.get("failures", 0) + 1
+        retry_banner_in(key, info, min(info["minutes"] * 60, BANNER_RETRY_BASE * 2 ** (info["failures"] - 1)))
+
+    if schedules.get(key) is info:
+        reschedule(key)
+
+async def dispatch_banner(key, info):
+    try:
+        account = banner_account(info)
+        if info.get("targets") is not None:
+            async with account.slots:
+                await fire_fanout(account, key, info)
             return
+        chat_id = info["from_chat"]
+        if chat_id not in account.chat_buckets:
+            account.chat_buckets[chat_id] = TokenBucket(BANNER_CHAT_RATE, BANNER_CHAT_BURST)
+        await account.chat_buckets[chat_id].acquire()
+        async with account.slots:
+            await account.global_bucket.acquire()
+            await fire_banner(account, key, info)
+    finally:
+        banners_in_flight.discard(key)
+        if schedules.get(key) not in (None, info):
+            reschedule(key)  # replaced by .set while in flight; its heap entry was skipped
 
-    # === .help ===
-    if text == ".help":
-        await event.edit(MESSAGES["help_message"], parse_mode='html')
-        await asyncio.sleep(60); await event.delete()
+async def banner_scheduler():
+    while not stop_event.is_set():
+        now_ts = get_tehran_time().timestamp()
+        while schedule_heap and schedule_heap[0][0] <= now_ts:
+            due_ts, _, key = heapq.heappop(schedule_heap)
+            info = schedules.get(key)
+            if info is None or info["next_run"].timestamp() != due_ts:
+                continue  # stale entry: banner was stopped or rescheduled
+            if key in banners_in_flight:
+                continue
+            banners_in_flight.add(key)
+            task = asyncio.create_task(dispatch_banner(key, info))
+            banner_tasks.add(task)
+            task.add_done_callback(banner_tasks.discard)
+
+        # Clear before reading the heap so a change made since the last wake-up
+        # is not lost between computing the delay and waiting.
+        schedule_changed.clear()
+        delay = SCHEDULER_HEARTBEAT
+        if schedule_heap:
+            delay = min(delay, max(0.0, schedule_heap[0][0] - time.time()))
+        try:
+            await asyncio.wait_for(schedule_changed.wait(), timeout=delay)
+        except asyncio.TimeoutError:
+            pass
+
+@client.on(events.MessageDeleted)
+async def banner_source_deleted(event):
+    for msg_id in event.deleted_ids:
+        cache_key = banner_msg_key(event.chat_id, msg_id)
+        banner_msg_cache.pop(cache_key)
+        for key in list(banners_by_source.get(cache_key, ())):
+            if key in banners_in_flight:  # an in-flight fire finds out on its own
+                continue
+            # Private/group ids are per account: only the owning account's
+            # deletion is about this banner's source.
+            if cache_key[0] is None and banner_account(schedules[key]).client is not event.client:
+                continue
+            remove_deleted_banner(key, schedules[key])
+
+# ================== GIF TOOLCHAIN ==================
+# Probed once in the background at startup: which ffmpeg (if any) is on PATH,
+# whether it has the filters and an H.264/MPEG-4 encoder .gif needs, and the
+# overlay font. process_gif reads the chosen pipeline instead of discovering
+# a missing tool through a failed first attempt.
+GIF_CORE_FILTERS = ("scale", "setpts", "reverse")
+GIF_ENCODERS = {  # in order of preference: encoder -> quality args
+    "libx264": ["-preset", "ultrafast", "-crf", "26"],
+    "libopenh264": ["-b:v", "1M"],
+    "mpeg4": ["-q:v", "5"],
+}
 
-    # === .set ===
-    elif text.startswith(".set "):
-        if not event.is_reply:
-            await event.edit(MESSAGES["set_reply_needed"])
-            await asyncio.sleep(5); await event.delete(); return
+gif_toolchain = {"pipeline": None, "ffmpeg": None, "encoder": None, "drawtext": False, "font": None, "probe_seconds": None}
+gif_toolchain_ready = asyncio.Event()
 
-        replied = await event.get_reply_message()
-        parts = raw_text.split()
+async def ffmpeg_output(*args):
+    process = await asyncio.create_subprocess_exec(
+        FFMPEG_BIN, "-hide_banner", *args,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL
+    )
+    try:
+        stdout_data, _ = await asyncio.wait_for(process.communicate(), timeout=PROBE_TIMEOUT)
+    except asyncio.TimeoutError:
+        process.kill(); await process.wait()
+        raise
+    return stdout_data.decode("utf-8", errors="ignore")
+
+def ffmpeg_listed_names(output):
+    # `ffmpeg -filters` / `-encoders` rows look like " T.. drawtext  V->V  Draw text..."
+    names = set()
+    for line in output.splitlines():
+        parts = line.split()
+        if len(parts) >= 2:
+            names.add(parts[1])
+    return names
+
+def probe_moviepy():
+    # The fallback uses moviepy.editor, which MoviePy 2.x no longer has, so the
+    # package being installed isn't enough. Finding the submodule imports the
+    # package itself, which is why this runs in a thread.
+    global HAS_MOVIEPY
+    try:
+        HAS_MOVIEPY = importlib.util.find_spec("moviepy.editor") is not None
+    except Exception:
+        HAS_MOVIEPY = False
+    if not HAS_MOVIEPY:
+        print("WARNING: MoviePy 1.x (moviepy.editor) not found. GIF fallback will not work. Install with: pip install 'moviepy<2'")
+
+async def probe_gif_toolchain():
+    started = time.monotonic()
+    try:
+        version = await ffmpeg_output("-version")
+        filters = ffmpeg_listed_names(await ffmpeg_output("-filters"))
+        encoders = ffmpeg_listed_names(await ffmpeg_output("-encoders"))
+        gif_toolchain["ffmpeg"] = version.splitlines()[0] if version else FFMPEG_BIN
+        gif_toolchain["drawtext"] = "drawtext" in filters
+        gif_toolchain["encoder"] = next((name for name in GIF_ENCODERS if name in encoders), None)
+        if gif_toolchain["encoder"] and all(name in filters for name in GIF_CORE_FILTERS):
+            gif_toolchain["pipeline"] = "ffmpeg"
+    except (OSError, asyncio.TimeoutError) as e:
+        print(f"• FFmpeg probe failed: {e}")
+
+    if HAS_MOVIEPY:
+        await asyncio.to_thread(probe_moviepy)
+    if not gif_toolchain["pipeline"] and HAS_MOVIEPY:
+        gif_toolchain["pipeline"] = "moviepy"
+
+    # Only the ffmpeg drawtext overlay uses the font.
+    if gif_toolchain["drawtext"]:
+        gif_toolchain["font"] = await ensure_fa_font()
+
+    gif_toolchain["probe_seconds"] = round(time.monotonic() - started, 3)
+    gif_toolchain_ready.set()
+    print(f"• GIF pipeline: {gif_toolchain['pipeline'] or 'unavailable'} "
+          f"(encoder: {gif_toolchain['encoder']}, drawtext: {gif_toolchain['drawtext']}, font: {bool(gif_toolchain['font'])})")
+
+# ================== GIF RENDER CACHE ==================
+# Rendered .gif outputs keyed by source media id + normalized filter chain.
+# A hit resends the already-uploaded Telegram document by reference; if the
+# reference is no longer valid the on-disk copy is re-uploaded instead, so
+# download and encode are skipped either way.
+gif_cache = None  # key -> {"file", "size", "used", "doc"}, loaded on first use
+gif_cache_lock = Lock()  # the index is only changed from worker threads holding this
+GIF_CACHE_INDEX = os.path.join(GIF_CACHE_DIR, "index.json")
+
+def gif_cache_key(media, caption_text, is_wide, raw_speed):
+    chain = json.dumps([media.id, caption_text, is_wide, raw_speed])
+    return hashlib.sha256(chain.encode()).hexdigest()
+
+def get_gif_cache():
+    global gif_cache
+    if gif_cache is None:
+        gif_cache = {}
+        if os.path.exists(GIF_CACHE_INDEX):
+            try:
+                with open(GIF_CACHE_INDEX) as f:
+                    gif_cache = json.load(f)
+            except Exception as e:
+                print(f"Load error (gif cache): {e}")
+    return gif_cache
+
+def store_gif_output(key, output_path, doc):
+    # Runs in a worker thread: moves the output into the cache and evicts
+    # least recently used entries beyond GIF_CACHE_MAX_BYTES.
+    with gif_cache_lock:
+        cache = get_gif_cache()
+        os.makedirs(GIF_CACHE_DIR, exist_ok=True)
+        file_name = key + os.path.splitext(output_path)[1]
+        shutil.move(output_path, os.path.join(GIF_CACHE_DIR, file_name))
+        entry = {"file": file_name, "size": os.path.getsize(os.path.join(GIF_CACHE_DIR, file_name)), "used": time.time(), "doc": doc}
+        cache[key] = entry
+
+        total = sum(entry["size"] for entry in cache.values())
+        for old_key in sorted(cache, key=lambda k: cache[k]["used"]):
+            if total <= GIF_CACHE_MAX_BYTES or old_key == key:
+                break
+            old_entry = cache.pop(old_key)
+            total -= old_entry["size"]
+            try:
+                os.remove(os.path.join(GIF_CACHE_DIR, old_entry["file"]))
+            except OSError:
+                pass
+        write_atomic(GIF_CACHE_INDEX, cache)
+
+def touch_gif_cache(key, doc=None, drop=False):
+    with gif_cache_lock:
+        cache = get_gif_cache()
+        if drop:
+            cache.pop(key, None)
+        elif key in cache:
+            cache[key]["used"] = time.time()
+            if doc is not None:
+                cache[key]["doc"] = doc
+        write_atomic(GIF_CACHE_INDEX, cache)
+
+def gif_doc_ref(message):
+    doc = utils.get_input_document(message.document)
+    return {"id": doc.id, "access_hash": doc.access_hash, "file_reference": doc.file_reference.hex()}
+
+async def send_cached_gif(job):
+    entry = get_gif_cache().get(job["cache_key"])
+    if entry is None:
+        return False
 
-        if len(parts) < 2:
-            await event.edit(MESSAGES["set_usage"])
-            await asyncio.sleep(5); await event.delete(); return
+    event = job["event"]
+    caption = MESSAGES["gif_cached"].format(elapsed=time.monotonic() - job["queued_at"]) + gif_caption_details(job)
+    send_kwargs = dict(
+        caption=caption.strip(),
+        reply_to=job["reply_message"],
+        force_document=False,
+        attributes=[DocumentAttributeVideo(w=512, h=512, duration=0, supports_streaming=True)]
+    )
+    doc = entry["doc"]
+    try:
+        file = types.InputDocument(id=doc["id"], access_hash=doc["access_hash"], file_reference=bytes.fromhex(doc["file_reference"]))
+        await client.send_file(event.chat_id, file, **send_kwargs)
+    except Exception:
+        # Stale file reference: fall back to re-uploading the cached render.
+        path = os.path.join(GIF_CACHE_DIR, entry["file"])
+        if not os.path.exists(path):
+            await asyncio.to_thread(touch_gif_cache, job["cache_key"], drop=True)
+            return False
+        sent = await client.send_file(event.chat_id, path, **send_kwargs)
+        doc = gif_doc_ref(sent)
+
+    await asyncio.to_thread(touch_gif_cache, job["cache_key"], doc)
+    await event.delete()
+    return True
+
+# ================== GIF JOBS ==================
+# .gif requests become jobs; at most GIF_WORKERS of them download/encode/upload
+# at once and the rest wait in FIFO order, showing their queue position.
+gif_workers = asyncio.Semaphore(GIF_WORKERS)
+gif_pending = []  # waiting jobs, oldest first
+gif_jobs = set()  # tasks of queued and running jobs
+gif_job_of = {}  # task -> job
+
+async def show_gif_queue_positions():
+    for position, job in enumerate(list(gif_pending), 1):
+        if job.get("position") != position:
+            job["position"] = position
+            try:
+                await job["event"].edit(MESSAGES["gif_queued"].format(position=position))
+            except Exception:
+                pass
 
-        interval_str = parts[1]
-        user_topic_id = None
-        if len(parts) >= 3 and parts[2].isdigit():
-            user_topic_id = int(parts[2])
+async def run_gif_job(job):
+    event = job["event"]
+    gif_job_of[job["task"]] = job
+    gif_pending.append(job)
+    try:
+        if gif_workers.locked():
+            await show_gif_queue_positions()
+        async with gif_workers:
+            gif_pending.remove(job)
+            job["started_at"] = time.monotonic()
+            asyncio.create_task(show_gif_queue_positions())
+            await event.edit(MESSAGES["gif_processing"])
+            await asyncio.wait_for(process_gif(job), timeout=GIF_JOB_BUDGET)
+    except asyncio.CancelledError:
+        await edit_and_delete(event, MESSAGES["gif_cancelled"], 5)
+    except asyncio.TimeoutError:
+        await edit_and_delete(event, MESSAGES["gif_conversion_failed"] + "\n\n`Time budget exceeded.`", 8)
+    finally:
+        if job in gif_pending:
+            gif_pending.remove(job)
+        gif_job_of.pop(job["task"], None)
+
+# The MoviePy fallback is pure CPU work holding the GIL, so it runs in worker
+# processes. Each worker is its own single-process executor so a job that
+# times out or is cancelled can be terminated without touching the others.
+gif_fallback_slots = asyncio.Semaphore(GIF_FALLBACK_WORKERS)
+gif_fallback_idle = []  # warm executors ready for reuse
+
+def moviepy_render_gif(input_path, output_path, speed, reverse):
+    # Runs in a worker process.
+    from moviepy.editor import VideoFileClip, vfx
+    clip = VideoFileClip(input_path)
+    try:
+        out = clip
+        if speed != 1.0:
+            out = out.speedx(speed)
+        if reverse and vfx and hasattr(vfx, 'reverse'):
+            out = out.fx(vfx.reverse)
+        # Apply time constraint (max 60 seconds)
+        if out.duration > 60:
+            out = out.subclip(0, 60)
+        out.write_gif(output_path, program='imageio', verbose=False, logger=None)
+    finally:
+        clip.close()
+
+def terminate_executor(executor):
+    # Workers inherit the SIGTERM handler that sets stop_event, so kill them outright
+    kill_workers = getattr(executor, "kill_workers", None)  # Python 3.14+
+    if kill_workers:
+        kill_workers()
+        return
+    for process in list((executor._processes or {}).values()):
+        process.kill()
+    executor.shutdown(wait=False, cancel_futures=True)
+
+async def run_gif_fallback(input_path, output_path, speed, reverse):
+    async with gif_fallback_slots:
+        executor = gif_fallback_idle.pop() if gif_fallback_idle else ProcessPoolExecutor(max_workers=1)
+        future = asyncio.get_running_loop().run_in_executor(executor, moviepy_render_gif, input_path, output_path, speed, reverse)
+        try:
+            await asyncio.wait_for(future, timeout=GIF_ENCODE_TIMEOUT)
+        except asyncio.TimeoutError:
+            terminate_executor(executor)
+            raise TimeoutError("MoviePy fallback timed out.")
+        except asyncio.CancelledError:
+            terminate_executor(executor)
+            raise
+        except BrokenProcessPool:
+            # The worker died (segfault, OOM kill); the executor can't run anything else
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        except Exception:
+            gif_fallback_idle.append(executor)
+            raise
+        gif_fallback_idle.append(executor)
+
+def shutdown_gif_fallback_pool():
+    while gif_fallback_idle:
+        gif_fallback_idle.pop().shutdown(wait=False, cancel_futures=True)
+
+def gif_caption_details(job):
+    details = ""
+    if job["caption_text"]: details += f"📝 • Text: {job['caption_text'][:50]}\n"
+    if job["raw_speed"] != 1.0: details += f"⏩ • Speed: {abs(job['raw_speed'])}x\n"
+    if job["is_wide"]: details += f"↔️ • Widened: ✅\n"
+    return details
+
+async def process_gif(job):
+    event = job["event"]
+    reply_message = job["reply_message"]
+    caption_text = job["caption_text"]
+    is_wide = job["is_wide"]
+    raw_speed = job["raw_speed"]
+    speed = job["speed"]
+    encode_time = 0.0
+
+    input_path = None
+    output_path = None
 
-        mins = sum(int(n) * (60 if u == "h" else 1) for n, u in re.findall(r"(\d+)\s*(h|m)", interval_str + "m"))
-        if mins < MIN_MINUTES:
-            await event.edit(MESSAGES["set_min_interval"])
-            await asyncio.sleep(5); await event.delete(); return
+    try:
+        await gif_toolchain_ready.wait()
+        if not gif_toolchain["pipeline"]:
+            await edit_and_delete(event, MESSAGES["gif_unavailable"], 8)
+            return
+        font_file = gif_toolchain["font"]
+        text_dropped = bool(caption_text) and not gif_toolchain["drawtext"]
 
-        schedule_key = user_topic_id if user_topic_id is not None else current_chat_id
+        with tempfile.NamedTemporaryFile(delete=False) as tmp_input:
+            input_path = tmp_input.name
+            await client.download_media(reply_message, file=input_path)
 
-        chat = await event.get_chat()
-        chat_title = getattr(chat, "title", "Private Chat")
-        if user_topic_id is not None:
-            try:
-                topic = await client(functions.messages.GetForumTopicRequest(peer=chat, topic_id=user_topic_id))
-                chat_title = f"{chat_title} → {topic.topic.title}"
-            except:
-                chat_title = f"{chat_title} → Topic #{user_topic_id}"
-        if event.is_private and event.chat_id == me.id:
-            chat_title = "Saved Messages"
 
-        now = get_tehran_time()
-        schedules[schedule_key] = {
-            "from_chat": replied.chat_id,
-            "msg_id": replied.id,
-            "topic_id": user_topic_id,
-            "minutes": mins,
-            "next_run": now + timedelta(minutes=mins),
-            "chat_title": chat_title
-        }
-        save()
+        if not os.path.exists(input_path) or os.path.getsize(input_path) == 0:
+            await event.edit(MESSAGES["gif_download_failed"]); await asyncio.sleep(5); await event.delete(); return
 
-        await event.edit(MESSAGES["set_success"].format(
-            chat_title=chat_title,
-            mins=format_interval(mins),
-            next_time=schedules[schedule_key]["next_run"].strftime("%H:%M:%S")
-        ))
-        await asyncio.sleep(8)
-        await event.delete()
+        ffmpeg_successful = False
+        # MoviePy runs first only when the startup probe chose it; otherwise
+        # it is the fallback for an FFmpeg error.
+        use_moviepy = gif_toolchain["pipeline"] == "moviepy"
 
-    # === .stop / .stopall ===
-    elif raw_text.lstrip().startswith((".stop", ".stopall")):
-        is_saved = event.is_private and event.chat_id == me.id
-
-        if raw_text.strip() == ".stopall" and is_saved:
-            count = len(schedules)
-            schedules.clear()
-            save()
-            plural = "s" if count != 1 else ""
-            await event.edit(MESSAGES["stopall_private"].format(count=count, plural=plural))
-            await asyncio.sleep(6); await event.delete(); return
-
-        parts = raw_text.split()
-        target_topic_id = None
-        if len(parts) >= 2 and parts[1].isdigit():
-            target_topic_id = int(parts[1])
-
-        key_to_stop = target_topic_id if target_topic_id is not None else current_chat_id
-
-        if key_to_stop in schedules:
-            title = schedules[key_to_stop]["chat_title"]
-            del schedules[key_to_stop]
-            save()
-            await event.edit(MESSAGES["stop_success"].format(chat_title=title))
-        else:
-            await event.edit(MESSAGES["stop_nothing"])
-        await asyncio.sleep(6)
-        await event.delete()
+        if not use_moviepy:
+            try:
+                # --- FFmpeg Conversion (Primary attempt) ---
+                vf_filters = []
 
-    # === .list ===
-    elif raw_text.lstrip().startswith(".list"):
-        parts = raw_text.split()
-        default_delay_seconds = 15
-        delete_delay_seconds = default_delay_seconds
+                # Start with scaling
+                vf_filters.append("scale=-2:512")
 
-        if len(parts) > 1:
-            interval_str = parts[1]
-            try:
-                parsed_minutes = sum(int(n) * (60 if u == "h" else 1) 
-                                     for n, u in re.findall(r"(\d+)\s*(h|m)", interval_str + "m"))
-                if parsed_minutes > 0:
-                    delete_delay_seconds = parsed_minutes * 60
-            except Exception:
-                pass
+                # Speed filter
+                if raw_speed < 0:
+                    vf_filters.append("reverse")
+                    vf_filters.append(f"setpts={1/speed}*PTS")
+                elif raw_speed > 0 and speed != 1.0:
+                    vf_filters.append(f"setpts={1/speed}*PTS")
 
-        if not schedules:
-            await event.edit(MESSAGES["list_empty"])
-            await asyncio.sleep(delete_delay_seconds)
-            await event.delete()
-            return
+                # Wide filter
+                if is_wide:
+                    vf_filters.append("scale=iw*2:ih")
 
-        lines = [MESSAGES["list_title"]]
-        now = get_tehran_time()
-        for i, (k, V) in enumerate(sorted(schedules.items(), key=lambda x: x[1]["next_run"]), 1):
-            left = int((V["next_run"] - now).total_seconds() / 60)
-            status = f"{left}m left" if left > 0 else "now"
-            lines.append(MESSAGES["list_item"].format(
-                i=i, title=V["chat_title"], mins=format_interval(V["minutes"]),
-                next_run=f"{V['next_run'].strftime('%H:%M:%S')} ({status})"
-            ))
-        lines.append(MESSAGES["list_tip"])
-        await event.edit("".join(lines), parse_mode='html')
-        await asyncio.sleep(delete_delay_seconds)
-        await event.delete()
+                # Text filter
+                if caption_text and not text_dropped:
+                    safe_text = caption_text.replace(":", "\\:").replace("'", "")
 
-    # === .date / .time ===
-    elif text in (".date", ".time"):
-        t = get_tehran_time()
-        l = datetime.now(ZoneInfo("Europe/London"))
-        c = datetime.now(ZoneInfo("America/Los_Angeles"))
-        msg = (
-            MESSAGES["date_tehran"].format(tehran_time=t.strftime("%H:%M:%S"), persian_date=format_persian_date(t)) +
-            MESSAGES["date_london"].format(london_time=l.strftime("%H:%M:%S"), london_date=l.strftime("%Y/%m/%d")) +
-            MESSAGES["date_california"].format(california_time=c.strftime("%H:%M:%S"), california_date=c.strftime("%Y/%m/%d"))
-        )
-        await event.edit(msg)
-        await asyncio.sleep(15); await event.delete()
-
-    # === .ping ===
-    elif text in (".ping", ".test", ".self"):
-        start = datetime.now()
-        e = await event.edit("**• Pinging...**")
-        ping = int((datetime.now() - start).total_seconds() * 1000)
-        await e.edit(MESSAGES["ping_success"].format(ping=ping))
-        await asyncio.sleep(5); await event.delete()
-
-    # === .card ===
-    elif text == ".card":
-        try:
-            card_message = MESSAGES["card_template"].format(
-                card_number=CARD_NUMBER,
-                card_holder=CARD_HOLDER
-            )
-        except Exception:
-            card_message = "**❌ • Card data or template is invalid!**"
+                    font_cmd = f"fontfile='{font_file}':" if font_file else ""
 
-        await event.edit(card_message)
+                    drawtext_cmd = (
+                        f"drawtext={font_cmd}text='{safe_text}':"
+                        "fontcolor=white:borderw=10:bordercolor=black:"
+                        "fontsize=(w/10):x=(w-text_w)/2:y=h-th-25"
+                    )
+                    vf_filters.append(drawtext_cmd)
 
-    # === .av / .bot ===
-    elif text in (".av", ".bot"):
-        await event.edit(MESSAGES["custom_message"], parse_mode='html')
+                filter_str = ",".join(vf_filters)
 
-    # === .alias [cmd] [text] ===
-    elif raw_text.lstrip().startswith(".alias"):
-        parts = raw_text.split(maxsplit=2)
+                with tempfile.NamedTemporaryFile(suffix=".mp4", delete=False) as tmp_output:
+                    output_path = tmp_output.name
 
-        if len(parts) < 2:
-            await event.edit(MESSAGES["alias_usage"]); await asyncio.sleep(5); await event.delete(); return
+                    ffmpeg_command = [
+                        FFMPEG_BIN, '-y',
+                        '-i', input_path,
+                        '-vf', filter_str,
+                        '-an',
+                        '-c:v', gif_toolchain["encoder"],
+                        *GIF_ENCODERS[gif_toolchain["encoder"]],
+                        '-pix_fmt', 'yuv420p',
+                        '-t', '60',
+                        '-f', 'mp4',
+                        output_path
+                    ]
 
-        cmd_name = parts[1].strip().lower()
+                    encode_start = time.monotonic()
+                    process = await asyncio.create_subprocess_exec(
+                        *ffmpeg_command,
+                        stdout=asyncio.subprocess.PIPE,
+                        stderr=asyncio.subprocess.PIPE
+                    )
 
-        if cmd_name == "del" and len(parts) == 3:
-            target_cmd = parts[2].strip().lower()
-            if target_cmd in aliases:
-                del aliases[target_cmd]
-                save()
-                await event.edit(MESSAGES["alias_deleted"].format(cmd=target_cmd)); await asyncio.sleep(5); await event.delete(); return
-            else:
-                await event.edit(MESSAGES["alias_not_found"].format(cmd=target_cmd)); await asyncio.sleep(5); await event.delete(); return
+                    try:
+                        stdout_data, stderr_data = await asyncio.wait_for(process.communicate(), timeout=GIF_ENCODE_TIMEOUT)
+                    except asyncio.TimeoutError:
+                        process.kill(); await process.wait()
+                        raise TimeoutError("FFmpeg process timed out.")
+                    except asyncio.CancelledError:
+                        process.kill(); await process.wait()
+                        raise
 
-        if len(parts) < 3:
-            await event.edit(MESSAGES["alias_usage"]); await asyncio.sleep(5); await event.delete(); return
+                    if process.returncode != 0:
+                        stderr = stderr_data.decode('utf-8', errors='ignore')
+                        raise RuntimeError(f"FFmpeg failed: {stderr[-400:]}")
 
-        alias_text = parts[2].strip()
+                encode_time = time.monotonic() - encode_start
+                gif_encodes_total.inc(pipeline="ffmpeg", outcome="ok")
+                gif_encode_seconds.observe(encode_time, pipeline="ffmpeg")
+                ffmpeg_successful = True
 
-        if alias_text:
-            aliases[cmd_name] = alias_text
-            save()
-            preview = alias_text[:50] + "..." if len(alias_text) > 50 else alias_text
-            await event.edit(MESSAGES["alias_success"].format(cmd=cmd_name, text_preview=preview), parse_mode='html')
-        else:
-            await event.edit(MESSAGES["alias_usage"])
-        await asyncio.sleep(8); await event.delete()
+            except Exception as e:
+                print(f"FFmpeg failed: {e}. Attempting MoviePy fallback...")
+                gif_encodes_total.inc(pipeline="ffmpeg", outcome="error")
 
-    # === .qr [url/text] ===
-    elif raw_text.lstrip().startswith(".qr") or raw_text.lstrip().startswith(".qrcode"):
-        qr_data = raw_text.lstrip()[3:].strip()
-        if not qr_data:
-            await event.edit(MESSAGES["qr_usage"]); await asyncio.sleep(5); await event.delete(); return
+                if not HAS_MOVIEPY:
+                    await event.edit(MESSAGES["gif_conversion_failed"] + "\n\n`MoviePy not installed for fallback.`")
+                    raise Exception("MoviePy is not available.")
+                await event.edit(MESSAGES["gif_fallback_text"])
+                use_moviepy = True
 
-        await event.edit("• Generating QR code...")
+        if use_moviepy:
+            # --- MoviePy Fallback Logic (NEW) ---
+            try:
+                # Create a new temp file for the GIF output
+                with tempfile.NamedTemporaryFile(suffix=".gif", delete=False) as tmp_gif_output:
+                    output_path = tmp_gif_output.name 
 
-        try:
-            qr = qrcode.QRCode(version=1, error_correction=qrcode.constants.ERROR_CORRECT_L, box_size=10, border=4)
-            qr.add_data(qr_data)
-            qr.make(fit=True)
-            img = qr.make_image(fill_color="black", back_color="white")
-
-            img_bytes = io.BytesIO()
-            img.save(img_bytes, format='PNG')
-            img_bytes.seek(0)
-
-            uploaded_file = await client.upload_file(
-                img_bytes,
-                file_name='waltself_qrcode.png'
-            )
+                encode_start = time.monotonic()
+                await run_gif_fallback(input_path, output_path, speed, raw_speed < 0)
 
-            await client.send_file(
-                event.chat_id,
-                uploaded_file,
-                caption=f"**🖼 • QR Code Data:**\n → `{qr_data[:200]}`"
-            )
-            await event.delete()
+                encode_time = time.monotonic() - encode_start
+                gif_encodes_total.inc(pipeline="moviepy", outcome="ok")
+                gif_encode_seconds.observe(encode_time, pipeline="moviepy")
 
-        except Exception:
-            await event.edit(MESSAGES["qr_error"]); await asyncio.sleep(5); await event.delete()
+                # Update file extension for proper captioning later
+                input_path = input_path.replace(os.path.splitext(input_path)[1], '.gif')
 
-    # === .translate [lang_code] [text] / .trans [lang_code] [text] ===
-    elif raw_text.lstrip().startswith(".translate") or raw_text.lstrip().startswith(".trans"):
-        parts = raw_text.split(maxsplit=2)
-        lang_code = ""
-        text_to_translate = ""
+                ffmpeg_successful = True
 
-        if len(parts) < 2:
-            await event.edit(MESSAGES["translate_usage"]); await asyncio.sleep(5); await event.delete(); return
+            except Exception as e_fallback:
+                print(f"MoviePy fallback failed: {e_fallback}")
+                gif_encodes_total.inc(pipeline="moviepy", outcome="error")
+                raise e_fallback 
 
-        lang_code = parts[1].strip()
+        if ffmpeg_successful:
+            is_gif_output = output_path.endswith('.gif')
 
-        if len(parts) == 3:
-            text_to_translate = parts[2].strip()
-        elif event.is_reply:
-            reply = await event.get_reply_message()
-            text_to_translate = reply.message or reply.text
+            # Upload the file
+            uploaded_file = await client.upload_file(output_path, file_name=f'waltself_gif.{("gif" if is_gif_output else "mp4")}')
 
-        if not text_to_translate:
-            await event.edit(MESSAGES["translate_usage"]); await asyncio.sleep(5); await event.delete(); return
+            proccess_time_s = time.monotonic() - job["queued_at"]
+            wait_time_s = job["started_at"] - job["queued_at"]
 
-        await event.edit("• Translating...")
+            caption_final = f"**✨ GIF Created in** `{proccess_time_s:.3f}s`\n"
+            caption_final += f"⏳ • Queue: `{wait_time_s:.1f}s` | 🎞 • Encode: `{encode_time:.1f}s`\n\n"
+            caption_final += gif_caption_details(job)
+            if is_gif_output and (caption_text or is_wide): 
+                caption_final += "**⚠️ • Note: Text/Wide effects applied ONLY to FFmpeg output, not MoviePy fallback.**"
+            elif text_dropped:
+                caption_final += MESSAGES["gif_no_drawtext"]
 
-        try:
-            url = f"https://translate.googleapis.com/translate_a/single?client=gtx&sl=auto&tl={lang_code}&dt=t&q={requests.utils.quote(text_to_translate)}"
-            r = requests.get(url, timeout=10)
-            r.raise_for_status()
 
-            translation_data = r.json()
-            translated_text = translation_data[0][0][0]
+            sent = await client.send_file(
+                event.chat_id,
+                uploaded_file,
+                caption=caption_final.strip(),
+                reply_to=reply_message,
+                force_document=False,
+                attributes=[DocumentAttributeVideo(w=512, h=512, duration=0, supports_streaming=True)]
+            )
+            await event.delete()
 
-            await event.edit(f"**🌐 • Translation ({lang_code.upper()}):**\n\n`{translated_text}`")
+            # MoviePy output ignores text/wide, so only full ffmpeg renders are cached.
+            if not is_gif_output and not text_dropped and sent.document:
+                try:
+                    await asyncio.to_thread(store_gif_output, job["cache_key"], output_path, gif_doc_ref(sent))
+                    output_path = None
+                except Exception as e:
+                    print(f"GIF cache store failed: {e}")
 
-        except Exception:
-            await event.edit(MESSAGES["translate_error"]); await asyncio.sleep(5); await event.delete()
+    except Exception as e:
+        print(f"GIF conversion failed: {e}")
+        error_msg = str(e)
+        if "FFmpeg" in error_msg: error_msg = "Processing Error (Check logs)"
+        await event.edit(MESSAGES["gif_conversion_failed"] + f"\n\n`{error_msg}`")
+        await asyncio.sleep(8); await event.delete()
 
+    finally:
+        if input_path and os.path.exists(input_path): os.remove(input_path)
+        if output_path and os.path.exists(output_path): os.remove(output_path)
 
-    # === .calc [expression] ===
-    elif raw_text.lstrip().startswith(".calc"):
-        expression = raw_text.lstrip()[5:].strip()
+# ================== COMMAND HANDLER ==================
+# Commands are registered with @command and resolved, together with aliases,
+# through one lookup in dispatch_table. Handlers receive the text after the
+# command name; raising CommandError shows a message and auto-deletes it.
+COMMANDS = {}
+dispatch_table = {}  # command or alias name -> command entry (dict) or AliasTemplate
+me = None  # cached get_me(), filled in main()
+
+class CommandError(Exception):
+    pass
+
+def command(*names, usage=None, delete_after=None, error_delete_after=5, needs_reply=False, reply_hint=None):
+    # usage: MESSAGES key shown when the command is sent without arguments.
+    # delete_after: seconds before a successful reply is deleted (None keeps it);
+    #               a handler may return a number to override it.
+    # needs_reply: show MESSAGES[reply_hint or usage] unless replying to a message.
+    def decorator(handler):
+        entry = {
+            "name": names[0],
+            "handler": handler,
+            "usage": usage,
+            "delete_after": delete_after,
+            "error_delete_after": error_delete_after,
+            "needs_reply": needs_reply,
+            "reply_hint": reply_hint or usage,
+        }
+        for name in names:
+            COMMANDS[name] = entry
+            if name not in aliases:
+                dispatch_table[name] = entry
+        return handler
+    return decorator
+
+# Aliases are compiled once, when defined or loaded: the HTML is parsed into
+# plain text and entities, and {field} placeholders become slots filled in
+# at send time. Entity offsets are in UTF-16 units, as Telegram counts them.
+ALIAS_FIELDS = {
+    "date": lambda now: now.strftime("%Y/%m/%d"),
+    "tehran_time": lambda now: now.strftime("%H:%M:%S"),
+    "persian_date": format_persian_date,
+    "card": lambda now: CARD_NUMBER,
+    "me": lambda now: f"@{me.username}" if me.username else utils.get_display_name(me),
+}
+ALIAS_SLOT = "\ue000"  # private-use char marking a field while the HTML is parsed
+
+class AliasTemplate:
+    def __init__(self, source):
+        # Raises ValueError for unknown fields, stray braces or empty text.
+        if ALIAS_SLOT in source:
+            raise ValueError("unsupported character U+E000")
+        html_parts, self.fields = [], []
+        for literal, field, spec, conversion in string.Formatter().parse(source):
+            html_parts.append(literal)
+            if field is None:
+                continue
+            if field not in ALIAS_FIELDS or spec or conversion:
+                raise ValueError(f"unknown field {{{field}}}")
+            self.fields.append(field)
+            html_parts.append(ALIAS_SLOT)
+
+        self.text, self.entities = telethon_html.parse("".join(html_parts))
+        self.pieces = self.text.split(ALIAS_SLOT)
+        if len(self.pieces) != len(self.fields) + 1:
+            raise ValueError("fields can only be used in text, not inside tags")
+        if not self.text.strip():
+            raise ValueError("empty text")
+        self.slots = [i for i, c in enumerate(helpers.add_surrogate(self.text)) if c == ALIAS_SLOT]
+
+    def render(self, now):
+        if not self.fields:
+            return self.text, self.entities
+        values = {field: str(ALIAS_FIELDS[field](now)) for field in set(self.fields)}
+        text = self.pieces[0] + "".join(values[f] + piece for f, piece in zip(self.fields, self.pieces[1:]))
+        growth = [len(helpers.add_surrogate(values[f])) - 1 for f in self.fields]
+        shift = lambda pos: pos + sum(g for slot, g in zip(self.slots, growth) if slot < pos)
+        entities = []
+        for entity in self.entities:
+            entity = copy.copy(entity)
+            start, end = shift(entity.offset), shift(entity.offset + entity.length)
+            entity.offset, entity.length = start, end - start
+            entities.append(entity)
+        return text, entities
+
+def compile_stored_alias(name, text):
+    try:
+        return AliasTemplate(text)
+    except ValueError:
+        pass
+    try:
+        # Saved before templates existed: braces in it are plain text.
+        return AliasTemplate(text.replace("{", "{{").replace("}", "}}"))
+    except ValueError as e:
+        print(f"Alias {name} skipped: {e}")
+        return None
+
+def rebuild_dispatch_table():
+    dispatch_table.clear()
+    dispatch_table.update(COMMANDS)
+    for name, text in aliases.items():  # aliases shadow built-in commands
+        template = compile_stored_alias(name, text)
+        if template is not None:
+            dispatch_table[name] = template
+
+def set_alias(name, text):
+    template = AliasTemplate(text)
+    aliases[name] = text
+    dispatch_table[name] = template
+    persist("alias", name)
+
+def delete_alias(name):
+    del aliases[name]
+    if name in COMMANDS:
+        dispatch_table[name] = COMMANDS[name]
+    else:
+        dispatch_table.pop(name, None)
+    persist("alias", name)
+
+def is_saved_messages(event):
+    return event.is_private and event.chat_id == me.id
+
+def parse_minutes(interval_str):
+    return sum(int(n) * (60 if u == "h" else 1) for n, u in re.findall(r"(\d+)\s*(h|m)", interval_str + "m"))
+
+async def edit_and_delete(event, text, delay, **kwargs):
+    await event.edit(text, **kwargs)
+    await asyncio.sleep(delay)
+    await event.delete()
 
-        if not expression:
-            await event.edit(MESSAGES["calc_error"]); await asyncio.sleep(5); await event.delete(); return
+@client.on(events.NewMessage(outgoing=True))
+async def commands(event):
+    raw_text = event.message.message
+    if not raw_text or raw_text[0] != ".":
+        return
+    if ALLOWED_USERS and event.sender_id not in ALLOWED_USERS:
+        return
 
-        allowed_chars = "0123456789+-*/(). "
-        if not all(c in allowed_chars for c in expression):
-            await event.edit(MESSAGES["calc_error"]); await asyncio.sleep(5); await event.delete(); return
+    parts = raw_text[1:].split(maxsplit=1)
+    if not parts:
+        return
+    entry = dispatch_table.get(parts[0].lower())
+    if entry is None:
+        return
 
-        try:
-            result = str(eval(expression))
-            await event.edit(MESSAGES["calc_success"].format(result=result))
-        except Exception:
-            await event.edit(MESSAGES["calc_error"])
-        await asyncio.sleep(8); await event.delete()
+    now = get_tehran_time()
+    if isinstance(entry, AliasTemplate):
+        commands_total.inc(command="alias", outcome="ok")
+        text, entities = entry.render(now)
+        await event.edit(text, formatting_entities=entities)
+        return
 
+    args = parts[1].strip() if len(parts) > 1 else ""
+    if entry["needs_reply"] and not event.is_reply:
+        commands_total.inc(command=entry["name"], outcome="usage")
+        await edit_and_delete(event, MESSAGES[entry["reply_hint"]], entry["error_delete_after"]); return
+    if entry["usage"] and not args:
+        commands_total.inc(command=entry["name"], outcome="usage")
+        await edit_and_delete(event, MESSAGES[entry["usage"]], entry["error_delete_after"]); return
+
+    started = time.perf_counter()
+    outcome = "error"
+    rejection = None
+    try:
+        delay = await entry["handler"](event, args)
+        outcome = "ok"
+    except CommandError as e:
+        outcome = "rejected"
+        rejection = str(e)
+    finally:
+        commands_total.inc(command=entry["name"], outcome=outcome)
+        command_seconds.observe(time.perf_counter() - started, command=entry["name"])
+
+    if rejection is not None:  # shown after timing so the auto-delete wait isn't counted
+        await edit_and_delete(event, rejection, entry["error_delete_after"]); return
+
+    delay = delay if delay is not None else entry["delete_after"]
+    if delay:
+        await asyncio.sleep(delay)
+        await event.delete()
 
-    # === .short [url] [slug] [expire hours] ===
-    elif raw_text.lstrip().startswith(".short"):
-        parts = raw_text.split()
+# === .help ===
+@command("help", delete_after=60)
+async def cmd_help(event, args):
+    await event.edit(MESSAGES["help_message"], parse_mode='html')
+
+# === .set [interval] [topic_id] ===
+@command("set", usage="set_usage", delete_after=8, needs_reply=True, reply_hint="set_reply_needed")
+async def cmd_set(event, args):
+    replied = await event.get_reply_message()
+    parts = args.split()
+
+    interval_str = parts[0]
+    user_topic_id = None
+    if len(parts) >= 2 and parts[1].isdigit():
+        user_topic_id = int(parts[1])
+
+    mins = parse_minutes(interval_str)
+    if mins < MIN_MINUTES:
+        raise CommandError(MESSAGES["set_min_interval"])
+
+    # Setting the same message again in the same topic updates that banner.
+    key = next((k for k in banners_by_chat.get(event.chat_id, ()) if k[1] == user_topic_id and schedules[k]["msg_id"] == replied.id), None)
+    if key is None:
+        key = (event.chat_id, user_topic_id, next_banner_id(event.chat_id))
+
+    chat = await event.get_chat()
+    chat_title = getattr(chat, "title", "Private Chat")
+    if user_topic_id is not None:
+        try:
+            topic = await client(functions.messages.GetForumTopicRequest(peer=chat, topic_id=user_topic_id))
+            chat_title = f"{chat_title} → {topic.topic.title}"
+        except:
+            chat_title = f"{chat_title} → Topic #{user_topic_id}"
+    if is_saved_messages(event):
+        chat_title = "Saved Messages"
+
+    account = await assign_banner_account(replied.chat_id)
+    now = get_tehran_time()
+    add_banner(key, {
+        "from_chat": replied.chat_id,
+        "msg_id": replied.id,
+        "topic_id": user_topic_id,
+        "minutes": mins,
+        "next_run": now + timedelta(minutes=mins),
+        "chat_title": chat_title,
+        "account": account
+    })
+    banner_msg_cache.set(banner_msg_key(replied.chat_id, replied.id), True)
+
+    await event.edit(MESSAGES["set_success"].format(
+        chat_title=chat_title,
+        mins=format_interval(mins),
+        next_time=schedules[key]["next_run"].strftime("%H:%M:%S"),
+        banner_id=key[2]
+    ))
+
+# === .stop [#id | topic_id] ===
+# No argument stops every banner in this chat, "#n" one banner, a number the
+# banners of that topic; replying stops the banners of the replied message.
+@command("stop", delete_after=6)
+async def cmd_stop(event, args):
+    keys = banners_by_chat.get(event.chat_id, set())
+    arg = args.split()[0] if args else ""
+    if arg.startswith("#") and arg[1:].isdigit():
+        keys = [k for k in keys if k[2] == int(arg[1:])]
+    elif arg.isdigit():
+        keys = [k for k in keys if k[1] == int(arg)]
+    elif event.is_reply:
+        replied = await event.get_reply_message()
+        keys = [k for k in banners_by_source.get(banner_msg_key(replied.chat_id, replied.id), ()) if k in keys]
 
-        if len(parts) < 2:
-            await event.edit(MESSAGES["short_usage"]); await asyncio.sleep(10); await event.delete(); return
+    keys = list(keys)
+    if not keys:
+        await event.edit(MESSAGES["stop_nothing"])
+        return
+    titles = [drop_banner(k)["chat_title"] for k in keys]
+    if len(titles) == 1:
+        await event.edit(MESSAGES["stop_success"].format(chat_title=titles[0]))
+    else:
+        await event.edit(MESSAGES["stop_success_many"].format(count=len(titles), chat_title=titles[0]))
+
+# === .stopall ===
+@command("stopall", delete_after=6)
+async def cmd_stopall(event, args):
+    if not is_saved_messages(event):
+        return await cmd_stop(event, args)
+
+    count = len(schedules)
+    clear_banners()
+    request_compaction()
+    plural = "s" if count != 1 else ""
+    await event.edit(MESSAGES["stopall_private"].format(count=count, plural=plural))
+
+# === .fanout [interval] [chat[:topic_id] ...] ===
+async def resolve_fanout_target(ref):
+    chat_ref, _, topic = ref.rpartition(":")
+    if not (chat_ref and topic.isdigit()):
+        chat_ref, topic = ref, None
+    try:
+        entity = await client.get_entity(int(chat_ref) if chat_ref.lstrip("-").isdigit() else chat_ref)
+    except Exception:
+        raise CommandError(MESSAGES["fanout_bad_target"].format(target=ref))
+    return {
+        "chat": utils.get_peer_id(entity),
+        "topic_id": int(topic) if topic else None,
+        "title": (getattr(entity, "title", None) or utils.get_display_name(entity)) + (f" → Topic #{topic}" if topic else ""),
+        "stats": None
+    }
+
+@command("fanout", usage="fanout_usage", delete_after=10, needs_reply=True, reply_hint="fanout_usage")
+async def cmd_fanout(event, args):
+    replied = await event.get_reply_message()
+    parts = args.split()
+    mins = parse_minutes(parts[0])
+    if mins < MIN_MINUTES:
+        raise CommandError(MESSAGES["set_min_interval"])
+    refs = list(dict.fromkeys(parts[1:]))
+    if not refs:
+        raise CommandError(MESSAGES["fanout_usage"])
+    if len(refs) > FANOUT_MAX_TARGETS:
+        raise CommandError(MESSAGES["fanout_too_many"])
+    targets = [await resolve_fanout_target(ref) for ref in refs]
+
+    fanout_id = max((int(k.split(":")[1]) for k in schedules if isinstance(k, str) and k.startswith("fanout:")), default=0) + 1
+    key = f"fanout:{fanout_id}"
+    now = get_tehran_time()
+    add_banner(key, {
+        "from_chat": replied.chat_id,
+        "msg_id": replied.id,
+        "topic_id": None,
+        "minutes": mins,
+        "next_run": now + timedelta(minutes=mins),
+        "chat_title": f"Fan-out #{fanout_id} → {len(targets)} chat{'s' if len(targets) != 1 else ''}",
+        "account": SESSION_NAME,  # the targets were resolved by this account
+        "targets": targets
+    })
+    banner_msg_cache.set(banner_msg_key(replied.chat_id, replied.id), True)
+
+    await event.edit(MESSAGES["fanout_success"].format(
+        id=fanout_id,
+        count=len(targets),
+        plural="s" if len(targets) != 1 else "",
+        mins=format_interval(mins),
+        next_time=schedules[key]["next_run"].strftime("%H:%M:%S")
+    ))
+
+# === .fanstop [id] ===
+@command("fanstop", usage="fanstop_usage", delete_after=6)
+async def cmd_fanstop(event, args):
+    fanout_id = args.split()[0].lstrip("#")
+    key = f"fanout:{fanout_id}"
+    if key not in schedules:
+        raise CommandError(MESSAGES["fanstop_nothing"].format(id=fanout_id))
+    drop_banner(key)
+    await event.edit(MESSAGES["fanstop_success"].format(id=fanout_id))
+
+# === .list [delete_after] ===
+@command("list")
+async def cmd_list(event, args):
+    delete_delay_seconds = 15
+    if args:
+        parsed_minutes = parse_minutes(args.split()[0])
+        if parsed_minutes > 0:
+            delete_delay_seconds = parsed_minutes * 60
+
+    if is_saved_messages(event):
+        items = list(schedules.items())
+    else:
+        items = [(k, schedules[k]) for k in banners_by_chat.get(event.chat_id, ())]
+    if not items:
+        await event.edit(MESSAGES["list_empty"])
+        return delete_delay_seconds
+
+    lines = [MESSAGES["list_title"]]
+    overall = lag_percentiles(banner_lag_samples)
+    if overall["samples"]:
+        lines.append(MESSAGES["list_global_lag"].format(
+            samples=overall["samples"], **{q: format_lag(overall[q]) for q in ("p50", "p95", "p99")}
+        ))
+    now = get_tehran_time()
+    for i, (k, V) in enumerate(sorted(items, key=lambda x: x[1]["next_run"]), 1):
+        left = int((V["next_run"] - now).total_seconds() / 60)
+        status = f"{left}m left" if left > 0 else "now"
+        stats_text = ""
+        if V.get("stats"):
+            lag = lag_percentiles(V.get("lag_samples"))
+            stats_text = MESSAGES["list_item_stats"].format(
+                sent=V["stats"]["sent"], failed=V["stats"]["failed"], flood_waits=V["stats"]["flood_waits"],
+                **{q: format_lag(lag[q]) for q in ("p50", "p95", "p99")}
+            )
+            if V["stats"]["last_error"]:
+                stats_text += MESSAGES["list_item_error"].format(error=html_escape(V["stats"]["last_error"][:80]))
+        if len(accounts) > 1:
+            stats_text += MESSAGES["list_item_account"].format(account=html_escape(banner_account(V).name))
+        for target in V.get("targets") or ():
+            target_stats = target.get("stats") or banner_stats({})
+            error = f" (<code>{html_escape(target_stats['last_error'][:60])}</code>)" if target_stats["last_error"] else ""
+            stats_text += MESSAGES["list_item_target"].format(
+                title=html_escape(target["title"]), sent=target_stats["sent"], failed=target_stats["failed"],
+                flood_waits=target_stats["flood_waits"], error=error
+            )
+        lines.append(MESSAGES["list_item"].format(
+            i=i, title=f"{V['chat_title']} · #{k[2]}" if isinstance(k, tuple) else V["chat_title"], mins=format_interval(V["minutes"]),
+            next_run=f"{V['next_run'].strftime('%H:%M:%S')} ({status})", stats=stats_text
+        ))
+    lines.append(MESSAGES["list_tip"])
+    await event.edit("".join(lines), parse_mode='html')
+    return delete_delay_seconds
+
+# === .date / .time ===
+@command("date", "time", delete_after=15)
+async def cmd_date(event, args):
+    t = get_tehran_time()
+    l = datetime.now(ZoneInfo("Europe/London"))
+    c = datetime.now(ZoneInfo("America/Los_Angeles"))
+    msg = (
+        MESSAGES["date_tehran"].format(tehran_time=t.strftime("%H:%M:%S"), persian_date=format_persian_date(t)) +
+        MESSAGES["date_london"].format(london_time=l.strftime("%H:%M:%S"), london_date=l.strftime("%Y/%m/%d")) +
+        MESSAGES["date_california"].format(california_time=c.strftime("%H:%M:%S"), california_date=c.strftime("%Y/%m/%d"))
+    )
+    await event.edit(msg)
+
+# === .ping ===
+@command("ping", "test", "self", delete_after=5)
+async def cmd_ping(event, args):
+    start = datetime.now()
+    e = await event.edit("**• Pinging...**")
+    ping = int((datetime.now() - start).total_seconds() * 1000)
+    await e.edit(MESSAGES["ping_success"].format(ping=ping))
+
+# === .card ===
+@command("card")
+async def cmd_card(event, args):
+    try:
+        card_message = MESSAGES["card_template"].format(
+            card_number=CARD_NUMBER,
+            card_holder=CARD_HOLDER
+        )
+    except Exception:
+        card_message = "**❌ • Card data or template is invalid!**"
+
+    await event.edit(card_message)
+
+# === .av / .bot ===
+@command("av", "bot")
+async def cmd_av(event, args):
+    await event.edit(MESSAGES["custom_message"], parse_mode='html')
+
+# === .alias [cmd] [text] / .alias del [cmd] ===
+@command("alias", usage="alias_usage", delete_after=8)
+async def cmd_alias(event, args):
+    parts = args.split(maxsplit=1)
+    cmd_name = parts[0].strip().lower()
+
+    if cmd_name == "del" and len(parts) == 2:
+        target_cmd = parts[1].strip().lower()
+        if target_cmd not in aliases:
+            raise CommandError(MESSAGES["alias_not_found"].format(cmd=target_cmd))
+        delete_alias(target_cmd)
+        await event.edit(MESSAGES["alias_deleted"].format(cmd=target_cmd))
+        return 5
+
+    alias_text = parts[1].strip() if len(parts) == 2 else ""
+    if not alias_text:
+        raise CommandError(MESSAGES["alias_usage"])
 
-        target_url = parts[1].strip()
+    try:
+        set_alias(cmd_name, alias_text)
+    except ValueError as e:
+        raise CommandError(MESSAGES["alias_invalid"].format(error=e))
+    preview = alias_text[:50] + "..." if len(alias_text) > 50 else alias_text
+    await event.edit(MESSAGES["alias_success"].format(cmd=cmd_name, text_preview=preview), parse_mode='html')
+
+# === .qr [-s box_size] [-e L|M|Q|H] [url/text] ===
+# Rendering runs in a worker thread; results are cached per (data, error
+# correction, box size) along with the sent photo so repeats skip both the
+# render and the upload.
+qr_cache = LRUCache(QR_CACHE_SIZE)
+
+def render_qr_png(data, error_correction, box_size):
+    import qrcode
+    qr = qrcode.QRCode(version=1, error_correction=getattr(qrcode.constants, f"ERROR_CORRECT_{error_correction}"), box_size=box_size, border=4)
+    qr.add_data(data)
+    qr.make(fit=True)
+    img = qr.make_image(fill_color="black", back_color="white")
+
+    img_bytes = io.BytesIO()
+    img.save(img_bytes, format='PNG')
+    return img_bytes.getvalue()
+
+@command("qr", "qrcode", usage="qr_usage")
+async def cmd_qr(event, args):
+    flags, qr_data = re.match(r"((?:-(?:e[lmqh]|s\d+)\s+)*)(.*)", args, re.S | re.I).groups()
+    qr_data = qr_data.strip()
+    if not qr_data:
+        raise CommandError(MESSAGES["qr_usage"])
+
+    error_correction, box_size = "L", 10
+    for flag in flags.split():
+        if flag[1].lower() == "e":
+            error_correction = flag[2].upper()
+        else:
+            box_size = min(max(int(flag[2:]), 1), QR_MAX_BOX_SIZE)
 
-        if not target_url.lower().startswith(('http://', 'https://')):
-            target_url = 'https://' + target_url
+    await event.edit("• Generating QR code...")
+    caption = f"**🖼 • QR Code Data:**\n → `{qr_data[:200]}`"
+    cache_key = (qr_data, error_correction, box_size)
 
-        if not is_url(target_url):
-            await event.edit(MESSAGES["short_invalid_url"]); await asyncio.sleep(10); await event.delete(); return
+    try:
+        cached = qr_cache.get(cache_key)
+        if cached and cached["photo"]:
+            try:
+                await client.send_file(event.chat_id, cached["photo"], caption=caption)
+                await event.delete()
+                return
+            except Exception:
+                pass  # expired file reference: upload the cached PNG again
 
-        slug = parts[2] if len(parts) > 2 and not parts[2].isdigit() else None
-        expire_hours = 0
+        png = cached["png"] if cached else await asyncio.to_thread(render_qr_png, qr_data, error_correction, box_size)
 
-        if len(parts) > 2 and parts[2].isdigit():
-            expire_hours = int(parts[2])
-        elif len(parts) > 3 and parts[3].isdigit():
-            expire_hours = int(parts[3])
+        uploaded_file = await client.upload_file(
+            png,
+            file_name='waltself_qrcode.png'
+        )
 
-        await event.edit("• Shortening URL...")
+        sent = await client.send_file(
+            event.chat_id,
+            uploaded_file,
+            caption=caption
+        )
+        qr_cache.set(cache_key, {"png": png, "photo": utils.get_input_photo(sent.photo) if sent.photo else None})
+        await event.delete()
 
-        payload = {
-            "domain": "clc.cx",
-            "target_url": target_url,
-            "expired_hours": expire_hours
-        }
-        if slug:
-            payload["slug"] = slug
-        if expire_hours > 0:
-            payload["expired_url"] = "https://google.com"
+    except Exception:
+        raise CommandError(MESSAGES["qr_error"])
 
-        headers = {
-            "Content-Type": "application/json",
-        }
+# === .translate [lang_code] [text] / .trans [lang_code] [text] ===
+@command("translate", "trans", usage="translate_usage")
+async def cmd_translate(event, args):
+    parts = args.split(maxsplit=1)
+    lang_code = parts[0].strip()
+    text_to_translate = ""
 
-        try:
-            r = requests.post("https://clc.is/api/links", headers=headers, json=payload, timeout=15)
+    if len(parts) == 2:
+        text_to_translate = parts[1].strip()
+    elif event.is_reply:
+        reply = await event.get_reply_message()
+        text_to_translate = reply.message or reply.text
 
-            response_data = r.json()
+    if not text_to_translate:
+        raise CommandError(MESSAGES["translate_usage"])
 
-            if isinstance(response_data, dict) and response_data.get('error'):
-                if response_data['error'] == "Slug already exists":
-                    await event.edit(MESSAGES["short_slug_error"]); await asyncio.sleep(10); await event.delete(); return
-                else:
-                    await event.edit(MESSAGES["short_api_error"].format(error=response_data['error'])); await asyncio.sleep(10); await event.delete(); return
+    await event.edit("• Translating...")
 
-            if isinstance(response_data, list) and response_data:
-                short_link_data = response_data[0]
-            else:
-                short_link_data = None 
+    try:
+        translated_text = await translate(text_to_translate, lang_code)
 
-            if not short_link_data or not isinstance(short_link_data, dict):
-                error_message = f"Invalid API Response Structure: {json.dumps(response_data)}"
-                await event.edit(MESSAGES["short_api_error"].format(error=error_message)); await asyncio.sleep(10); await event.delete(); return
+        await event.edit(f"**🌐 • Translation ({lang_code.upper()}):**\n\n`{translated_text}`")
 
-            if short_link_data.get('is_generated') is False and slug:
-                await event.edit(MESSAGES["short_slug_error"]); await asyncio.sleep(10); await event.delete(); return
+    except Exception:
+        raise CommandError(MESSAGES["translate_error"])
 
-            short_url = short_link_data.get('url')
+# === .calc [expression] ===
+@command("calc", usage="calc_error", delete_after=8)
+async def cmd_calc(event, args):
+    expression = args
 
-            if not short_url:
-                await event.edit(MESSAGES["short_api_error"].format(error="Missing 'url' in API response.")), await asyncio.sleep(10); await event.delete(); return
+    allowed_chars = "0123456789+-*/(). "
+    if not all(c in allowed_chars for c in expression):
+        raise CommandError(MESSAGES["calc_error"])
 
-            expires_text = f"\n\n**⏰ • Expires in:** {expire_hours} hour(s)" if expire_hours > 0 else ""
-            success_message = MESSAGES["short_success"].format(short_url=short_url, target_url=target_url) + expires_text
+    try:
+        result = str(eval(expression))
+        await event.edit(MESSAGES["calc_success"].format(result=result))
+    except Exception:
+        await event.edit(MESSAGES["calc_error"])
+
+# === .short [url] [slug] [expire hours] ===
+@command("short", usage="short_usage", error_delete_after=10)
+async def cmd_short(event, args):
+    parts = args.split()
+    target_url = parts[0].strip()
+
+    if not target_url.lower().startswith(('http://', 'https://')):
+        target_url = 'https://' + target_url
+
+    if not is_url(target_url):
+        raise CommandError(MESSAGES["short_invalid_url"])
+
+    slug = parts[1] if len(parts) > 1 and not parts[1].isdigit() else None
+    expire_hours = 0
+
+    if len(parts) > 1 and parts[1].isdigit():
+        expire_hours = int(parts[1])
+    elif len(parts) > 2 and parts[2].isdigit():
+        expire_hours = int(parts[2])
+
+    await event.edit("• Shortening URL...")
+
+    payload = {
+        "domain": "clc.cx",
+        "target_url": target_url,
+        "expired_hours": expire_hours
+    }
+    if slug:
+        payload["slug"] = slug
+    if expire_hours > 0:
+        payload["expired_url"] = "https://google.com"
+
+    headers = {
+        "Content-Type": "application/json",
+    }
 
-            await event.edit(success_message)
+    try:
+        _, response_data = await http_request("POST", SHORTENER_URL, headers=headers, json=payload, timeout=15)
+    except asyncio.TimeoutError:
+        raise CommandError(MESSAGES["short_api_error"].format(error="Request timed out. API is slow or down."))
+    except aiohttp.ClientError as e:
+        raise CommandError(MESSAGES["short_api_error"].format(error=f"Connection error: {e.__class__.__name__}"))
+    except Exception as e:
+        raise CommandError(MESSAGES["short_api_error"].format(error=f"Unknown Error: {e.__class__.__name__}"))
 
-        except requests.exceptions.Timeout:
-            await event.edit(MESSAGES["short_api_error"].format(error="Request timed out. API is slow or down.")); await asyncio.sleep(10); await event.delete()
-        except requests.exceptions.RequestException as e:
-            error_message = f"Connection error: {e.__class__.__name__}"
-            await event.edit(MESSAGES["short_api_error"].format(error=error_message)); await asyncio.sleep(10); await event.delete()
-        except Exception as e:
-            await event.edit(MESSAGES["short_api_error"].format(error=f"Unknown Error: {e.__class__.__name__}")), await asyncio.sleep(10); await event.delete()
-
-    # === .gif [text] [flags] ===
-    elif raw_text.lstrip().startswith(".gif"):
-        start_time = time.time()
-
-        if not event.is_reply:
-            await event.edit(MESSAGES["gif_usage"])
-            await asyncio.sleep(5); await event.delete(); return
-
-        reply_message = await event.get_reply_message()
-
-        is_valid_media = reply_message.photo or reply_message.video or reply_message.sticker
-        if not is_valid_media:
-            await event.edit(MESSAGES["gif_invalid_media"])
-            await asyncio.sleep(5); await event.delete(); return
-
-        args_raw = raw_text.lstrip()[4:].strip()
-        
-        flag_pattern = r'(-[wW]|-[.0-9]+[xX])'
-        
-        flags_found = re.findall(flag_pattern, args_raw)
-        
-        caption_text = args_raw
-        for flag in flags_found:
-            caption_text = caption_text.replace(flag, ' ')
-        
-        caption_text = ' '.join(caption_text.split()).strip()
-
-        is_wide = any(f.lower() == '-w' for f in flags_found)
-        raw_speed = 1.0
-        
-        for f in flags_found:
-            sm = re.match(r'(-?[\d\.]+)x', f.lower().strip())
-            if sm:
-                try:
-                    raw_speed = float(sm.group(1))
-                except:
-                    pass
-        
-        speed = abs(raw_speed) if abs(raw_speed) > 0 else 1.0 
+    if isinstance(response_data, dict) and response_data.get('error'):
+        if response_data['error'] == "Slug already exists":
+            raise CommandError(MESSAGES["short_slug_error"])
+        raise CommandError(MESSAGES["short_api_error"].format(error=response_data['error']))
 
-        await event.edit(MESSAGES["gif_processing"])
+    if isinstance(response_data, list) and response_data:
+        short_link_data = response_data[0]
+    else:
+        short_link_data = None
 
-        input_path = None
-        output_path = None
+    if not short_link_data or not isinstance(short_link_data, dict):
+        error_message = f"Invalid API Response Structure: {json.dumps(response_data)}"
+        raise CommandError(MESSAGES["short_api_error"].format(error=error_message))
 
-        try:
-            font_file = ensure_fa_font()
-            
-            with tempfile.NamedTemporaryFile(delete=False) as tmp_input:
-                input_path = tmp_input.name
-                await client.download_media(reply_message, file=input_path)
+    if short_link_data.get('is_generated') is False and slug:
+        raise CommandError(MESSAGES["short_slug_error"])
 
+    short_url = short_link_data.get('url')
 
-            if not os.path.exists(input_path) or os.path.getsize(input_path) == 0:
-                await event.edit(MESSAGES["gif_download_failed"]); await asyncio.sleep(5); await event.delete(); return
+    if not short_url:
+        raise CommandError(MESSAGES["short_api_error"].format(error="Missing 'url' in API response."))
 
-            ffmpeg_successful = False
-            
-            try:
-                # --- FFmpeg Conversion (Primary attempt) ---
-                vf_filters = []
-                
-                # Start with scaling
-                vf_filters.append("scale=-2:512")
-                
-                # Speed filter
-                if raw_speed < 0:
-                    vf_filters.append("reverse")
-                    vf_filters.append(f"setpts={1/speed}*PTS")
-                elif raw_speed > 0 and speed != 1.0:
-                    vf_filters.append(f"setpts={1/speed}*PTS")
+    expires_text = f"\n\n**⏰ • Expires in:** {expire_hours} hour(s)" if expire_hours > 0 else ""
+    success_message = MESSAGES["short_success"].format(short_url=short_url, target_url=target_url) + expires_text
 
-                # Wide filter
-                if is_wide:
-                    vf_filters.append("scale=iw*2:ih")
+    await event.edit(success_message)
 
-                # Text filter
-                if caption_text:
-                    safe_text = caption_text.replace(":", "\\:").replace("'", "")
-                    
-                    font_cmd = f"fontfile='{font_file}':" if font_file else ""
-                    
-                    drawtext_cmd = (
-                        f"drawtext={font_cmd}text='{safe_text}':"
-                        "fontcolor=white:borderw=10:bordercolor=black:"
-                        "fontsize=(w/10):x=(w-text_w)/2:y=h-th-25"
-                    )
-                    vf_filters.append(drawtext_cmd)
+# === .gif [text] [flags] ===
+@command("gif", needs_reply=True, reply_hint="gif_usage")
+async def cmd_gif(event, args):
+    reply_message = await event.get_reply_message()
 
-                filter_str = ",".join(vf_filters)
+    is_valid_media = reply_message.photo or reply_message.video or reply_message.sticker
+    if not is_valid_media:
+        raise CommandError(MESSAGES["gif_invalid_media"])
 
-                with tempfile.NamedTemporaryFile(suffix=".mp4", delete=False) as tmp_output:
-                    output_path = tmp_output.name
+    flag_pattern = r'(-[wW]|-[.0-9]+[xX])'
 
-                    ffmpeg_command = [
-                        'ffmpeg', '-y',
-                        '-i', input_path,
-                        '-vf', filter_str,
-                        '-an',
-                        '-c:v', 'libx264',
-                        '-preset', 'ultrafast',
-                        '-crf', '26',
-                        '-pix_fmt', 'yuv420p',
-                        '-t', '60',
-                        '-f', 'mp4',
-                        output_path
-                    ]
+    flags_found = re.findall(flag_pattern, args)
 
-                    process = await asyncio.create_subprocess_exec(
-                        *ffmpeg_command,
-                        stdout=asyncio.subprocess.PIPE,
-                        stderr=asyncio.subprocess.PIPE
-                    )
+    caption_text = args
+    for flag in flags_found:
+        caption_text = caption_text.replace(flag, ' ')
 
-                    try:
-                        stdout_data, stderr_data = await asyncio.wait_for(process.communicate(), timeout=90.0)
-                    except asyncio.TimeoutError:
-                        process.kill(); await process.wait()
-                        raise TimeoutError("FFmpeg process timed out.")
+    caption_text = ' '.join(caption_text.split()).strip()
 
-                    if process.returncode != 0:
-                        stderr = stderr_data.decode('utf-8', errors='ignore')
-                        raise RuntimeError(f"FFmpeg failed: {stderr[-400:]}")
+    is_wide = any(f.lower() == '-w' for f in flags_found)
+    raw_speed = 1.0
 
-                ffmpeg_successful = True
+    for f in flags_found:
+        sm = re.match(r'(-?[\d\.]+)x', f.lower().strip())
+        if sm:
+            try:
+                raw_speed = float(sm.group(1))
+            except:
+                pass
 
-            except Exception as e:
-                print(f"FFmpeg failed: {e}. Attempting MoviePy fallback...")
-                
-                # --- MoviePy Fallback Logic (NEW) ---
-                if VideoFileClip is None:
-                    await event.edit(MESSAGES["gif_conversion_failed"] + "\n\n`MoviePy not installed for fallback.`")
-                    raise Exception("MoviePy is not available.")
-                
-                try:
-                    await event.edit(MESSAGES["gif_fallback_text"])
-                    
-                    # Create a new temp file for the GIF output
-                    with tempfile.NamedTemporaryFile(suffix=".gif", delete=False) as tmp_gif_output:
-                        output_path = tmp_gif_output.name 
-                    
-                    clip = VideoFileClip(input_path)
-                    
-                    # Apply speed
-                    if speed != 1.0:
-                        clip = clip.speedx(speed)
-                        
-                    # Reverse if needed
-                    if raw_speed < 0 and vfx and hasattr(vfx, 'reverse'):
-                        clip = clip.fx(vfx.reverse) 
-                        
-                    # Apply time constraint (max 60 seconds)
-                    if clip.duration > 60:
-                        clip = clip.subclip(0, 60)
-                        
-                    # Write the file as a GIF (using imageio)
-                    clip.write_gif(output_path, program='imageio', verbose=False, logger=None)
-                    
-                    # Update file extension for proper captioning later
-                    input_path = input_path.replace(os.path.splitext(input_path)[1], '.gif')
-                    
-                    ffmpeg_successful = True
-                    
-                except Exception as e_fallback:
-                    print(f"MoviePy fallback failed: {e_fallback}")
-                    raise e_fallback 
-
-            if ffmpeg_successful:
-                is_gif_output = output_path.endswith('.gif')
-                
-                # Upload the file
-                uploaded_file = await client.upload_file(output_path, file_name=f'waltself_gif.{("gif" if is_gif_output else "mp4")}')
-
-                stop_time = time.time()
-                proccess_time_s = stop_time - start_time 
-
-                caption_final = f"**✨ GIF Created in** `{proccess_time_s:.3f}s`\n\n"
-                if caption_text: caption_final += f"📝 • Text: {caption_text[:50]}\n"
-                if raw_speed != 1.0: caption_final += f"⏩ • Speed: {abs(raw_speed)}x\n"
-                if is_wide: caption_final += f"↔️ • Widened: ✅\n"
-                if is_gif_output and (caption_text or is_wide): 
-                    caption_final += "**⚠️ • Note: Text/Wide effects applied ONLY to FFmpeg output, not MoviePy fallback.**"
-
-                
-                await client.send_file(
-                    event.chat_id,
-                    uploaded_file,
-                    caption=caption_final.strip(),
-                    reply_to=reply_message,
-                    force_document=False,
-                    attributes=[DocumentAttributeVideo(w=512, h=512, duration=0, supports_streaming=True)]
-                )
-                await event.delete()
+    speed = abs(raw_speed) if abs(raw_speed) > 0 else 1.0 
+
+    job = {
+        "event": event,
+        "chat_id": event.chat_id,
+        "reply_message": reply_message,
+        "caption_text": caption_text,
+        "is_wide": is_wide,
+        "raw_speed": raw_speed,
+        "speed": speed,
+        "queued_at": time.monotonic(),
+    }
+    media = reply_message.photo or reply_message.document
+    job["cache_key"] = gif_cache_key(media, caption_text, is_wide, raw_speed)
+    if await send_cached_gif(job):
+        return
 
-        except Exception as e:
-            print(f"GIF conversion failed: {e}")
-            error_msg = str(e)
-            if "FFmpeg" in error_msg: error_msg = "Processing Error (Check logs)"
-            await event.edit(MESSAGES["gif_conversion_failed"] + f"\n\n`{error_msg}`")
-            await asyncio.sleep(8); await event.delete()
+    job["task"] = asyncio.create_task(run_gif_job(job))
+    gif_jobs.add(job["task"])
+    job["task"].add_done_callback(gif_jobs.discard)
+
+# === .gifcancel ===
+@command("gifcancel", delete_after=5)
+async def cmd_gifcancel(event, args):
+    count = 0
+    for task in list(gif_jobs):
+        job = gif_job_of.get(task)
+        if job and job["chat_id"] == event.chat_id and not task.done():
+            task.cancel()
+            count += 1
+    if not count:
+        raise CommandError(MESSAGES["gif_cancel_nothing"])
+    await event.edit(MESSAGES["gif_cancel_done"].format(count=count))
+
+# === .profile [seconds] (Saved Messages only) ===
+# cProfile is only enabled for the requested window, so there is no cost
+# when no profile is running. It hooks the event loop's thread, which is
+# where every handler and coroutine runs.
+profile_running = False
+
+def build_profile_report(profiler, seconds, started_at, command_counts):
+    buf = io.StringIO()
+    buf.write(f"Walt Self-Bot profile: {seconds}s window from {started_at:%Y-%m-%d %H:%M:%S} (Tehran)\n\n")
+    buf.write("Commands handled in window:\n")
+    for (name, outcome), count in sorted(command_counts.items()):
+        buf.write(f"  .{name} [{outcome}]: {count}\n")
+    if not command_counts:
+        buf.write("  (none)\n")
+    stats = pstats.Stats(profiler, stream=buf).strip_dirs()
+    for sort, title in (("cumulative", "cumulative time"), ("tottime", "own (wall) time")):
+        buf.write(f"\n===== Top {PROFILE_TOP} functions by {title} =====\n")
+        stats.sort_stats(sort).print_stats(PROFILE_TOP)
+    return buf.getvalue().encode("utf-8")
+
+@command("profile", delete_after=10)
+async def cmd_profile(event, args):
+    global profile_running
+    if not is_saved_messages(event):
+        raise CommandError(MESSAGES["profile_saved_only"])
+    if args and not args.split()[0].isdigit():
+        raise CommandError(MESSAGES["profile_usage"])
+    if profile_running:
+        raise CommandError(MESSAGES["profile_busy"])
+    seconds = max(1, min(PROFILE_MAX_SECONDS, int(args.split()[0]) if args else PROFILE_DEFAULT_SECONDS))
+
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:  # another profiler is attached
+        raise CommandError(MESSAGES["profile_busy"])
+    profile_running = True
+    started_at = get_tehran_time()
+    counts_before = dict(commands_total.values)
+    try:
+        await event.edit(MESSAGES["profile_started"].format(seconds=seconds))
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.disable()
+        profile_running = False
+
+    command_counts = {k: v - counts_before.get(k, 0) for k, v in commands_total.values.items() if v != counts_before.get(k, 0)}
+    report = await asyncio.to_thread(build_profile_report, profiler, seconds, started_at, command_counts)
+    uploaded = await client.upload_file(report, file_name=f"walt_profile_{started_at:%Y%m%d_%H%M%S}.txt")
+    await client.send_file(event.chat_id, uploaded, caption=MESSAGES["profile_done"].format(seconds=seconds), force_document=True)
+    await event.edit(MESSAGES["profile_done"].format(seconds=seconds))
 
+# ================== SELF-DESTRUCT SAVER ==================
+# Saves are queued by shortest ttl_seconds first and handled by SAVER_WORKERS
+# workers, which together keep at most SAVER_MAX_INFLIGHT_BYTES of media in flight.
+saver_queue = asyncio.PriorityQueue(maxsize=SAVER_QUEUE_SIZE)
+saver_seq = itertools.count()
+saver_stats = {"queued": 0, "saved": 0, "dropped": 0, "failed": 0, "peak_buffer_bytes": 0}
+saver_inflight_bytes = 0
+saver_inflight_changed = asyncio.Condition()
+saver_admission = asyncio.Lock()  # FIFO: saves wait for byte budget in dequeue order
+
+# Display info for senders and chats, keyed by marked peer id. Filled from the
+# entities that arrive with the update itself, so captions need no extra RPCs.
+entity_names = LRUCache(2048, ttl=ENTITY_CACHE_TTL)
+
+def remember_entity(entity):
+    if entity is None:
+        return None
+    info = {
+        "id": entity.id,
+        "name": utils.get_display_name(entity),
+        "username": getattr(entity, "username", None),
+        "title": getattr(entity, "title", None),
+    }
+    entity_names.set(utils.get_peer_id(entity), info)
+    return info
+
+async def lookup_entity(peer_id, fetch):
+    info = entity_names.get(peer_id) if peer_id is not None else None
+    if info is None:
+        info = remember_entity(await fetch())
+    return info
+
+async def reserve_saver_bytes(size):
+    global saver_inflight_bytes
+    async with saver_admission, saver_inflight_changed:
+        # A file bigger than the whole cap still goes through, on its own.
+        await saver_inflight_changed.wait_for(
+            lambda: saver_inflight_bytes == 0 or saver_inflight_bytes + size <= SAVER_MAX_INFLIGHT_BYTES
+        )
+        saver_inflight_bytes += size
+
+async def release_saver_bytes(size):
+    global saver_inflight_bytes
+    async with saver_inflight_changed:
+        saver_inflight_bytes -= size
+        saver_inflight_changed.notify_all()
+
+async def saver_worker():
+    while True:
+        _, _, message = await saver_queue.get()
+        size = getattr(message.file, "size", None) or 0
+        await reserve_saver_bytes(size)
+        try:
+            await save_self_destruct(message)
         finally:
-            if input_path and os.path.exists(input_path): os.remove(input_path)
-            if output_path and os.path.exists(output_path): os.remove(output_path)
+            await release_saver_bytes(size)
+            saver_queue.task_done()
+
+class MeteredSpool(tempfile.SpooledTemporaryFile):
+    # Tracks what a save really buffers: the most bytes the spool held in RAM
+    # before rolling over to disk, plus the largest chunk read back out of it
+    # (one upload part, copied into memory while it is sent).
+    def __init__(self, max_size):
+        super().__init__(max_size=max_size)
+        self.peak_ram = 0
+        self.largest_read = 0
+
+    def write(self, s):
+        if not self._rolled:
+            self.peak_ram = max(self.peak_ram, self._file.tell() + len(s))
+        return super().write(s)
+
+    def read(self, *args):
+        data = super().read(*args)
+        self.largest_read = max(self.largest_read, len(data))
+        return data
+
+    @property
+    def peak_buffer(self):
+        return self.peak_ram + self.largest_read
 
-# ================== SELF-DESTRUCT SAVER ==================
 async def save_self_destruct(message):
     if not getattr(message.media, "ttl_seconds", None):
         return
+    # Media is streamed through a spooled file: it stays in RAM up to
+    # SAVER_SPOOL_BYTES and spills to disk beyond that, whatever its size.
+    spool = MeteredSpool(SAVER_SPOOL_BYTES)
+    started = time.perf_counter()
+    outcome = "failed"
     try:
-        sender = await message.get_sender()
-        username = f"@{sender.username}" if sender and sender.username else "—"
-        full_name = f"{sender.first_name or ''} {sender.last_name or ''}".strip() or "Deleted Account"
-        user_id = sender.id if sender else "Unknown"
-        chat = await client.get_entity(message.chat_id)
-        chat_title = getattr(chat, "title", None) or "Private Chat"
-
-        file_bytes = await client.download_media(message, bytes)
-        if not file_bytes: return
+        sender = await lookup_entity(message.sender_id, message.get_sender)
+        username = f"@{sender['username']}" if sender and sender["username"] else "—"
+        full_name = (sender["name"] if sender else "") or "Deleted Account"
+        user_id = sender["id"] if sender else "Unknown"
+        chat = await lookup_entity(message.chat_id, lambda: message.client.get_entity(message.chat_id))
+        chat_title = (chat["title"] if chat else None) or "Private Chat"
+
+        await message.client.download_media(message, file=spool)
+        size = spool.tell()
+        if not size:
+            outcome = "empty"
+            return
+        spool.seek(0)
 
         attributes = []
         force_document = False
@@ -996,43 +2708,127 @@ async def save_self_destruct(message):
             utc_time=datetime.now(ZoneInfo("UTC")).strftime("%H:%M:%S")
         )
 
-        file = await client.upload_file(file_bytes, file_name=filename)
-        await client.send_message(CHANNEL, full_caption, file=file, attributes=attributes, force_document=force_document, silent=True)
-        print(f"SAVED self-destruct → {filename}")
+        file = await message.client.upload_file(spool, file_name=filename, file_size=size)
+        await message.client.send_message(CHANNEL, full_caption, file=file, attributes=attributes, force_document=force_document, silent=True)
+
+        peak_buffer = spool.peak_buffer
+        saver_buffer_bytes.observe(peak_buffer)
+        saver_stats["peak_buffer_bytes"] = max(saver_stats["peak_buffer_bytes"], peak_buffer)
+        saver_stats["saved"] += 1
+        outcome = "saved"
+        print(
+            f"SAVED self-destruct → {filename} | {size / 1048576:.1f} MB, "
+            f"peak buffer {peak_buffer / 1048576:.1f} MB{' (spilled to disk)' if spool._rolled else ''}"
+        )
     except Exception as e:
+        saver_stats["failed"] += 1
         print(f"Self-destruct save failed: {e}")
+    finally:
+        spool.close()
+        saver_jobs_total.inc(outcome=outcome)
+        saver_job_seconds.observe(time.perf_counter() - started)
 
 @client.on(events.NewMessage(incoming=True))
 async def auto_self_destruct(event):
-    if getattr(event.message.media, "ttl_seconds", None):
-        asyncio.create_task(save_self_destruct(event.message))
+    ttl = getattr(event.message.media, "ttl_seconds", None)
+    if ttl:
+        remember_entity(event.message.sender)
+        remember_entity(event.message.chat)
+        try:
+            saver_queue.put_nowait((ttl, next(saver_seq), event.message))
+            saver_stats["queued"] += 1
+        except asyncio.QueueFull:
+            saver_stats["dropped"] += 1
+            saver_jobs_total.inc(outcome="dropped")
+            print(f"Self-destruct save dropped: queue full ({SAVER_QUEUE_SIZE})")
 
 # ================== MAIN ==================
-def run_flask():
-    flask_app.run(host='0.0.0.0', port=os.getenv("PORT", 8080), debug=False, use_reloader=False)
+async def warm_up_imports():
+    # Import the lazily loaded modules off the event loop so the first .qr,
+    # .date or GIF fallback doesn't pay for it.
+    for name in WARMUP_MODULES:
+        if importlib.util.find_spec(name.split(".")[0]) is None:
+            continue
+        started = time.perf_counter()
+        try:
+            await asyncio.to_thread(importlib.import_module, name)
+        except Exception as e:
+            print(f"Warm-up import of {name} failed: {e}")
+            continue
+        print(f"• Warmed up {name} in {time.perf_counter() - started:.2f}s")
+
+async def start_extra_accounts():
+    # One at a time, since a new session asks for its phone and code on the
+    # console. They share this process's status server, GIF workers and saver.
+    for name in EXTRA_SESSIONS:
+        if name in accounts:
+            continue
+        extra = TelegramClient(name, API_ID, API_HASH)
+        extra.add_event_handler(banner_source_deleted, events.MessageDeleted())
+        extra.add_event_handler(auto_self_destruct, events.NewMessage(incoming=True))
+        try:
+            await extra.start()
+            account = Account(name, extra)
+            account.me = await extra.get_me()
+        except Exception as e:
+            print(f"• Account {name} failed to start: {e}")
+            await extra.disconnect()
+            continue
+        accounts[name] = account
+        print(f"Logged in as {account.me.first_name} (@{account.me.username or 'no username'}) [{name}]")
 
 async def main():
-    # Start Flask Thread
-    print("• Starting Flask web server...")
-    flask_thread = Thread(target=run_flask)
-    flask_thread.daemon = True
-    flask_thread.start()
+    print("• Starting status server...")
+    status_runner = await start_status_server()
     
+    # Runs alongside connect/login so the first .gif never waits on discovery.
+    client.loop.create_task(probe_gif_toolchain())
+
     print("• Starting Walt Self-Bot...")
+    phase_start = time.perf_counter()
+    await client.connect()
+    startup_times["connect"] = time.perf_counter() - phase_start
+
+    phase_start = time.perf_counter()
     await client.start(phone=PHONE)
+    global me
     me = await client.get_me()
     print(f"Logged in as {me.first_name} (@{me.username or 'no username'})")
-
     await client(functions.account.UpdateStatusRequest(offline=False))
+    accounts[SESSION_NAME].me = me
+    startup_times["login"] = time.perf_counter() - phase_start
+
+    if EXTRA_SESSIONS:
+        phase_start = time.perf_counter()
+        await start_extra_accounts()
+        startup_times["accounts"] = time.perf_counter() - phase_start
+
+    phase_start = time.perf_counter()
     load()
+    startup_times["load"] = time.perf_counter() - phase_start
+    startup_times["total"] = time.perf_counter() - startup_started
+    print("• Startup: " + ", ".join(f"{k} {v:.2f}s" for k, v in startup_times.items()))
+
+    if WARMUP_IMPORTS:
+        client.loop.create_task(warm_up_imports())
     client.loop.create_task(banner_scheduler())
+    client.loop.create_task(persistence_flusher())
+    if len(accounts) > 1:
+        client.loop.create_task(rebalance_banners())
+    for _ in range(SAVER_WORKERS):
+        client.loop.create_task(saver_worker())
 
     print("• Bot is running... Press Ctrl+C to stop.")
     await stop_event.wait()
 
     print("• Shutting down...")
-    save()
-    await client.disconnect()
+    async with persist_lock:
+        save()
+    await status_runner.cleanup()
+    await close_http_session()
+    shutdown_gif_fallback_pool()
+    for account in accounts.values():
+        await account.client.disconnect()
 
 if __name__ == "__main__":
     asyncio.run(main())